@@ -1,5 +1,5 @@
 # Simple script to use the C preprocessor
 # ./asmcpp.sh asm/testmacro.asm
-cpp $@ a.asm
-python3 assembler.py a.asm -3 -s
-rm -f a.asm
+# cpp output is piped straight into the assembler - no temporary file.
+# The output is named after the source file (asm/testmacro.hex)
+cpp $@ | python3 assembler.py - -3 -s
@@ -27,26 +27,83 @@
 """
 import sys
 import os.path
+import re
+import io
+import hashlib
+import pickle
+import json
+import time
+import contextlib
+import cProfile
+import tracemalloc
+import functools
+import concurrent.futures
+import socketserver
+import stat
+import array
+from collections import OrderedDict
+import logisim
+import isa
 from enum import Enum, auto
 from dataclasses import dataclass
 from abc import abstractmethod, ABC
+from typing import NamedTuple
 
 
 WSPACE = "\f\v\r\t\n "
 RAM_ADDRESS = 0x8000
 ROM_ADDRESS = 0x0000
 
-@dataclass
+class Device(NamedTuple):
+    name: str
+    start: int
+    end: int
+
+# The memory devices - and so the images written once a program uses '.section'
+DEVICES = {
+    'rom' : Device('rom', ROM_ADDRESS, RAM_ADDRESS),
+    'ram' : Device('ram', RAM_ADDRESS, 0x10000),
+}
+
+# Section -> the device it goes in when not given ('.section rodata,ram') - None for the device 'code' is in
+SECTIONS = {'code' : None, 'rodata' : None, 'bss' : 'ram'}
+
+STDIN_SOURCE = '-'      # source file name which reads from stdin
+STDIN_BASENAME = 'a'    # output file base name when stdin is not from cpp
+
 class AssemblerOperation:
-    operation : str = None
-    pc : int = None
-    size : int = 0
-    data : str = None
-    reg : int = None
-    regr : int = None
-    source_file:str = None
-    source_line:int = None
+    """
+    One operation parsed from a line. There is one of these for every line of a
+    source - so they are slotted (no per instance __dict__) rather than a dataclass.
+    """
+    __slots__ = ('operation', 'pc', 'size', 'data', 'reg', 'regr', 'source_file', 'source_line')
+
+    def __init__(self, operation: str = None, pc: int = None, size: int = 0, data: 'Data' = None,
+                 reg: int = None, regr: int = None, source_file: str = None, source_line: int = None):
+        self.operation = operation
+        self.pc = pc
+        self.size = size
+        self.data = data
+        self.reg = reg
+        self.regr = regr
+        self.source_file = source_file
+        self.source_line = source_line
+
+    def clone(self) -> 'AssemblerOperation':
+        """Shallow copy - the (read only) Data object is shared"""
+        return AssemblerOperation(self.operation, self.pc, self.size, self.data,
+                                  self.reg, self.regr, self.source_file, self.source_line)
+
+    def fields(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return self.fields() == other.fields() if isinstance(other, AssemblerOperation) else NotImplemented
+
+    __hash__ = None
 
+    def __repr__(self):
+        return 'AssemblerOperation(' + ', '.join(f'{name}={value!r}' for name, value in zip(self.__slots__, self.fields())) + ')'
 
 
 class Dissassembler:
@@ -98,64 +155,42 @@ class Dissassembler:
                     data = ''.join([f'{_x:02X}' for _i,_x in enumerate(op.data.getData())])
                     return op.operation +'\t'+ f'{data}'
 
+        class DissFill(BaseDissassembler):
 
-        def dissassemble(self,op:AssemblerOperation) -> str:
-            disactions = {
-                        'movwi'   : self.DissRegImmediate16(),
-                        'ld'   : self.DissRegImmediate16(),
-                        'st'   : self.DissRegImmediate16(),
-                        'djnz'   : self.DissRegImmediate16(),
-
-                        'shl'  : self.DissSingleReg(),
-                        'shr'  : self.DissSingleReg(),
-
-                        'out'  : self.DissSingleReg(),
-                        'inc'  : self.DissSingleReg(),
-                        'dec'  : self.DissSingleReg(),
-
-                        'call' : self.DissImmediate16(),
-                        'jmp' : self.DissImmediate16(),
-                        'jpz' : self.DissImmediate16(),
-                        'jpnz' : self.DissImmediate16(),
-                        'jpc' : self.DissImmediate16(),
-                        'jpnc' : self.DissImmediate16(),
-                        'jps' : self.DissImmediate16(),
-                        'jpns' : self.DissImmediate16(),
-                        'jpo' : self.DissImmediate16(),
-                        'jpno' : self.DissImmediate16(),
-                        'jpv' : self.DissImmediate16(),
-                        'jpnv' : self.DissImmediate16(),
-
-                        'movi' : self.DissImmediate(),
-                        'addi' : self.DissImmediate(),
-                        'subi' : self.DissImmediate(),
-                        'andi' : self.DissImmediate(),
-                        'ori' :  self.DissImmediate(),
-                        'xori' : self.DissImmediate(),
-
-                        'mov' : self.DissRegReg(),
-                        'add' : self.DissRegReg(),
-                        'sub' : self.DissRegReg(),
-                        'and' : self.DissRegReg(),
-                        'or' : self.DissRegReg(),
-                        'xor' : self.DissRegReg(),
-                        'swp' : self.DissRegReg(),
-
-                        'hlt' : self.DissSingleByteOpCode(),
-                        'nop' : self.DissSingleByteOpCode(),
-                        'ret' : self.DissSingleByteOpCode(),
-                        'clc' : self.DissSingleByteOpCode(),
-                        'setc' : self.DissSingleByteOpCode(),
-                        'exx' : self.DissSingleByteOpCode(),
+                def dissassemble(self,op: AssemblerOperation) -> str:
+                    return op.operation +'\t'+ f'{op.size},0x{op.data.getData()[0]:02x}'
 
+        class DissIncbin(BaseDissassembler):
+
+                def dissassemble(self,op: AssemblerOperation) -> str:
+                    return op.operation +'\t'+ f"'{op.data.getRawData()}' ({op.size} bytes)"
+
+
+        # Formatter for each instruction form - by instruction size for forms with an immediate
+        FORM_FORMATTERS = {
+            'single' : DissSingleByteOpCode,
+            'regreg' : DissRegReg,
+            'word' : DissImmediate16,
+            'indirect' : DissSingleByteIndirectOpCode,
+            'reg' : {1: DissSingleReg, 2: DissImmediate, 3: DissRegImmediate16},
+            'operand' : {1: DissSingleReg, 3: DissRegImmediate16},
+        }
+
+        def __init__(self):
+            # Built once - not on every dissassemble() call
+            self.disactions = {
                         'db' : self.DissData(),
                         'dw' : self.DissData(),
                         'dt' : self.DissData(),
-
-                        'ist' : self.DissSingleByteIndirectOpCode(),
-                        'ild' : self.DissSingleByteIndirectOpCode(),
-
+                        'fill' : self.DissFill(),
+                        'incbin' : self.DissIncbin(),
                     }
+            for mnemonic, encoding in isa.instruction_set().encoding.items():
+                formatter = self.FORM_FORMATTERS[encoding.form]
+                self.disactions[mnemonic] = (formatter[encoding.size] if isinstance(formatter, dict) else formatter)()
+
+        def dissassemble(self,op:AssemblerOperation) -> str:
+            disactions = self.disactions
             return f'{ "?"+op.operation if op.operation not in disactions else disactions[op.operation].dissassemble(op)}'
 
 
@@ -166,6 +201,8 @@ class OperationNotSupported(Exception):
         super().__init__(self.message)
 
 class Data(ABC):
+    __slots__ = ('data',)
+
     def __init__(self,data):
         self.data = data
 
@@ -191,6 +228,8 @@ class FunctionData(Data):
     # movi r0,@LOW(0x2fff)
     # movi r1,@HIGH(0x2fff)
 
+    __slots__ = ('fnc',)
+
     def __init__(self, fnc, data):
         super().__init__(data)
         self.fnc = fnc
@@ -205,6 +244,7 @@ class FunctionData(Data):
         return f"FunctionData: fnc:{self.fnc} {super().__str__()}"
 
 class SymbolWordData(Data):
+    __slots__ = ('lut',)
 
     def __init__(self, data, lookup):
         super().__init__(data)
@@ -214,12 +254,21 @@ class SymbolWordData(Data):
         value = self.lut[self.data]
         return [value & 0xff, value>>8 & 0xff]
 
+    def __getstate__(self):
+        # The symbol table is not pickled with the operation - see SourceParser.rebind
+        return self.data
+
+    def __setstate__(self, state):
+        self.data = state
+        self.lut = None
+
     def __str__(self):
         return f"SymbolWordData: {super().__str__()}"
     def __repr__(self):
         return f"SymbolWordData: {super().__str__()}"
 
 class WordData(Data):
+    __slots__ = ()
 
     def __init__(self, data):
         super().__init__(data)
@@ -234,6 +283,7 @@ class WordData(Data):
         return f"WordData: {super().__str__()}"
 
 class ByteData(Data):
+    __slots__ = ()
 
     def __init__(self, data):
         super().__init__(data & 0xff)
@@ -248,6 +298,7 @@ class ByteData(Data):
         return f"ByteData: {super().__str__()}"
 
 class StringData(Data):
+    __slots__ = ()
 
     def __init__(self, data):
         #print(f"StringData: {data}")
@@ -261,6 +312,46 @@ class StringData(Data):
     def __repr__(self):
         return f"StringData: {super().__str__()}"
 
+class BytesData(Data):
+    # The whole payload of a '.db 1,2,3' or '.dw' list or a '.fill' - one bytes
+    # object copied straight into the image rather than an operation per value
+    __slots__ = ()
+
+    def __init__(self, data):
+        super().__init__(bytes(data))
+
+    def getData(self):
+        return self.data
+
+    def __str__(self):
+        return f"BytesData: {len(self.data)} bytes"
+    def __repr__(self):
+        return f"BytesData: {len(self.data)} bytes"
+
+class FileData(Data):
+    # .incbin 'file' - the file name as written. Its bytes are read by the
+    # SourceParser as the operation is assembled - and not kept in the parse cache
+    __slots__ = ('content',)
+
+    def __init__(self, data, content = b''):
+        super().__init__(data)
+        self.content = content
+
+    def getData(self):
+        return self.content
+
+    def __getstate__(self):
+        return self.data
+
+    def __setstate__(self, state):
+        self.data = state
+        self.content = b''
+
+    def __str__(self):
+        return f"FileData: {super().__str__()} {len(self.content)} bytes"
+    def __repr__(self):
+        return f"FileData: {super().__str__()} {len(self.content)} bytes"
+
 @dataclass
 class SupportOperation:
     data : str = None
@@ -344,54 +435,14 @@ class NullByteCodeBuilder(ByteCodeBuilder):
 
 
 class IndirectByteCodeBuilder(ByteCodeBuilder):
+    def __init__(self, table):
+        self.table = table
 
     def build_bytecode(self, support: SupportOperation) -> [int]:
-        #print(f"IndirectByteCodeBuilder: BUILD INDIRECT {support}")
-        try:
-            #print(f"opcode: '{support.operation}' r{support.reg}, ({support.regr})'")
-
-            lookup = f'{support.reg}{support.regr}'
-            # Match current buildcontrolrom.py as of 14/10/24
-
-            opcode_table = {
-            'ild':{
-
-                #'0r2': 0x00,
-                #'0r3': 0x00,
-
-                #'1r2': 0x00,
-                #'1r3': 0x00,
-
-                '2r0': 0x4e,
-                '2r1': 0x4e,
-
-                '3r0': 0x4f,
-                '3r1': 0x4f,
-                },
-            'ist':{
-
-                #'0r2': 0x00,
-                #'0r3': 0x00,
-
-                #'1r2': 0x00,
-                #'1r3': 0x00,
-
-                '2r0': 0x4a,
-                '2r1': 0x4a,
-
-                '3r0': 0x4b,
-                '3r1': 0x4b,
-                }
-            }
-            try:
-                bytecode = opcode_table[support.operation][lookup]
-                return [bytecode]
-            except Exception as e:
-                print(f"Exception in lookup {e}")
-                raise OperationNotSupported(f"opcode: '{support.operation}' r{support.reg}, ({support.regr})'")
-        except OperationNotSupported as e:
-            print(f"{e}")
-        return []
+        bytecode = self.table.get((support.reg, support.regr))
+        if (bytecode is None):
+            raise OperationNotSupported(f"Exception in lookup '{support.reg}{support.regr}'\nopcode: '{support.operation}' r{support.reg}, ({support.regr})'")
+        return [bytecode]
 
 class DataByteCodeBuilder(ByteCodeBuilder):
 
@@ -400,9 +451,10 @@ class DataByteCodeBuilder(ByteCodeBuilder):
 
 
 class ReserveSpaceByteCodeBuilder(ByteCodeBuilder):
+    # Only zeros the image - the output files skip reserved space (see ProgramImage.segment_table)
 
     def build_bytecode(self, support: SupportOperation) -> [int]:
-        return [0]*support.size
+        return bytes(support.size)
 
 
 class OutputType(Enum):
@@ -415,76 +467,9 @@ class BuildOperation:
     build : str
     bytecode : int = None
 
+# Builders for the directives - and the operations which produce no code.
+# The instructions are added from the ISA tables (see isa.py) on first use.
 codeBuilder= {
-    'mov' : DoubleRegByteCodeBuilder(SimpleByteCodeResolver(0x90)),
-    'movi' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x40)),
-    'movwi' : TripleByteCodeBuilder(LookupByOperandByteCodeResolver({'sp':0x1c,'r0':0x28, 'r1':0x28, 'r2':0x2a, 'r3': 0x2a})),    # set SP/R0R1/R2R3 with a 16-bit address
-
-    'csp' : SingleByteCodeBuilder(LookupByOperandByteCodeResolver({0:0x48, 1:0x48, 2:0x49, 3: 0x49})),
-
-    'ld' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x14)),
-    'st' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x18)),
-
-    'out' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x10)),
-    'inc' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x88)),
-    'dec' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x8c)),
-
-    'decsp' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x1e)),
-    'incsp' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x1d)),
-
-    'pushr0' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x1f)),
-    'pushr2' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x20)),
-    'pushall' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x21)),
-    'popr0' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x22)),
-    'popr2' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x23)),
-    'popall' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x24)),
-
-    'shr' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x80)),
-    'shl' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x84)),
-
-    'add' : DoubleRegByteCodeBuilder(SimpleByteCodeResolver(0xa0)),
-    'sub' : DoubleRegByteCodeBuilder(SimpleByteCodeResolver(0xb0)),
-    'and' : DoubleRegByteCodeBuilder(SimpleByteCodeResolver(0xc0)),
-    'or' : DoubleRegByteCodeBuilder(SimpleByteCodeResolver(0xd0)),
-    'xor' : DoubleRegByteCodeBuilder(SimpleByteCodeResolver(0xe0)),
-    'swp' : DoubleRegByteCodeBuilder(SimpleByteCodeResolver(0x30)),
-
-
-    'addi' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x50)),
-    'subi' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x54)),
-    'andi' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x58)),
-    'ori' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x5c)),
-    'xori' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x44)),
-
-    'djnz' : SingleRegByteCodeBuilder(SimpleByteCodeResolver(0x60)),
-
-    'jpz' : TripleByteCodeBuilder(SimpleByteCodeResolver(0x64)),
-    'jpnz' : TripleByteCodeBuilder(SimpleByteCodeResolver(0x65)),
-
-    'jpc' : TripleByteCodeBuilder(SimpleByteCodeResolver(0x66)),
-    'jpnc' : TripleByteCodeBuilder(SimpleByteCodeResolver(0x67)),
-
-    'jps' : TripleByteCodeBuilder(SimpleByteCodeResolver(0x68)),
-    'jpns' : TripleByteCodeBuilder(SimpleByteCodeResolver(0x69)),
-
-    'jpv' : TripleByteCodeBuilder(SimpleByteCodeResolver(0x6a)),
-    'jpnv' : TripleByteCodeBuilder(SimpleByteCodeResolver(0x6b)),
-
-    'jmp' : TripleByteCodeBuilder(SimpleByteCodeResolver(0x6c)),
-    'call' : TripleByteCodeBuilder(SimpleByteCodeResolver(0x6e)),
-
-    'ret' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x6f)),
-
-    'clc' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x01)),
-    'setc' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x02)),
-    'nop' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x00)),
-    'exx' : SingleByteCodeBuilder(SimpleByteCodeResolver(0x25)),
-    'hlt' : SingleByteCodeBuilder(SimpleByteCodeResolver(0xff)),
-
-    # Indirect addressing
-    'ist':IndirectByteCodeBuilder(),
-    'ild':IndirectByteCodeBuilder(),
-
     'cppline' : NullByteCodeBuilder(),
     'cppbuiltin' : NullByteCodeBuilder(),
 
@@ -496,16 +481,46 @@ codeBuilder= {
     'dw' : DataByteCodeBuilder(),
     'ds' : ReserveSpaceByteCodeBuilder(),
     'dt' : DataByteCodeBuilder(),
+    'fill' : DataByteCodeBuilder(),
+    'incbin' : DataByteCodeBuilder(),
 
     'end' : NullByteCodeBuilder(),
+    'section' : NullByteCodeBuilder(),
 }
 
 
+def encodingBuilder(encoding: isa.Encoding) -> ByteCodeBuilder:
+    form = encoding.form
+    if (form == 'single'):
+        return SingleByteCodeBuilder(SimpleByteCodeResolver(encoding.bytecode))
+    if (form == 'reg'):
+        return SingleRegByteCodeBuilder(SimpleByteCodeResolver(encoding.bytecode))
+    if (form == 'regreg'):
+        return DoubleRegByteCodeBuilder(SimpleByteCodeResolver(encoding.bytecode))
+    if (form == 'word'):
+        return TripleByteCodeBuilder(SimpleByteCodeResolver(encoding.bytecode))
+    if (form == 'operand'):
+        resolver = LookupByOperandByteCodeResolver(encoding.bytecodes)
+        return SingleByteCodeBuilder(resolver) if encoding.size == 1 else TripleByteCodeBuilder(resolver)
+    return IndirectByteCodeBuilder(encoding.bytecodes)
+
+
+@functools.lru_cache(maxsize = None)
+def instructionBuilders() -> dict:
+    """codeBuilder along with a builder for every mnemonic in the instruction set"""
+    builders = {mnemonic: encodingBuilder(encoding) for mnemonic, encoding in isa.instruction_set().encoding.items()}
+    builders.update(codeBuilder)
+    return builders
+
 
 class Builder:
-    def __init__(self,symtable):
+    # Diagnostics go to 'log' - stdout if None
+    def __init__(self,symtable, log = None):
         self.symtable =  symtable
+        self.builders = instructionBuilders()
         self.cachewarning = set()
+        self.errors = 0
+        self.log = log
 
 
     def build(self, op):
@@ -517,25 +532,616 @@ class Builder:
 
     def warning(self, str, nm):
         if (nm not in self.cachewarning):
-            print("**WARNING** "+str,nm)
+            print("**WARNING** "+str,nm, file = self.log)
             self.cachewarning.add(nm)
 
     def opCodeBuilder(self, op: AssemblerOperation) -> [int]:
         nm = op.operation
-        if (nm in codeBuilder):
+        if (nm in self.builders):
             try:
-                builder = codeBuilder[nm]
+                builder = self.builders[nm]
                 so = op
                 binarray = builder.build_bytecode(so)
                 return binarray
             except KeyError as e:
-                print(f"SymbolTable Error {e}")
+                print(f"SymbolTable Error {e}", file = self.log)
+                self.errors += 1
+                return []
+            except OperationNotSupported as e:
+                print(f"{e}", file = self.log)
                 return []
         else:
-            print("Can not find opCode builder for ",op)
+            print("Can not find opCode builder for ",op, file = self.log)
             return []
 
 
+class SymbolError(Exception):
+        def __init__(self,msg):
+            self.msg = msg
+        def __str__(self):
+            return f"**SymbolError**: {self.msg}"
+
+class ImageError(Exception):
+        def __init__(self,msg):
+            self.msg = msg
+        def __str__(self):
+            return f"**ImageError**: {self.msg}"
+
+
+class Segment(NamedTuple):
+    address: int
+    length: int
+    reserved: bool = False      # '.ds' space - addresses only, nothing to write
+
+
+class ProgramImage:
+    """
+    The assembled program - a 64K memory image plus, in source order, each
+    operation with the number of bytes it placed there. Filled once by the
+    Assembler; every output format is serialized from views over 'memory'.
+    """
+    SIZE = 0x10000
+    RESERVED = frozenset(['ds'])    # operations whose bytes are reserved space - not content
+
+    def __init__(self, offset: int = RAM_ADDRESS):
+        self.memory = bytearray(self.SIZE)
+        self.view = memoryview(self.memory)     # also pins the size of 'memory'
+        self.ops = []                           # operations in source order
+        self.lengths = array.array('I')         # ... and the number of bytes each placed
+        self.used = bytearray(self.SIZE)        # 1 for each address an operation has placed a byte at
+        self.index = None                       # address -> op whose bytes start there - built by op_at()
+        self.offset = offset                    # base address of the memory device (RAM or ROM) - for V3 hex
+        self.labels = {}                        # symbol table - filled in by assemble()
+        self.errors = 0
+        self.log = ''                           # everything assemble() printed
+
+    def place(self, op: AssemblerOperation, binarray: [int]) -> int:
+        """Append an operation - returns its position in 'ops'"""
+        self.ops.append(op)
+        self.lengths.append(0)
+        self.index = None
+        position = len(self.ops) - 1
+        self.write(position, binarray)
+        return position
+
+    def write(self, position: int, binarray: [int]) -> None:
+        op = self.ops[position]
+        end = op.pc + len(binarray)
+        if (op.pc < 0 or end > self.SIZE):
+            raise ImageError(f"'{op.operation}' at 0x{op.pc:04x} is outside the 64K address space")
+        # A fixup writes its operation's bytes again - anything else must go where nothing has been placed
+        if (self.lengths[position] == 0 and binarray):
+            overlap = self.used.find(1, op.pc, end)
+            if (overlap != -1):
+                raise ImageError(f"'{op.operation}' at 0x{op.pc:04x} overwrites code already placed at 0x{overlap:04x} - check the '.org's")
+            self.used[op.pc:end] = b'\x01' * len(binarray)
+        self.memory[op.pc:end] = bytes(binarray)
+        self.lengths[position] = len(binarray)
+
+    def op_at(self, address: int) -> AssemblerOperation:
+        """The operation whose bytes start at 'address' - None if none do"""
+        # Only built when something looks an address up - most runs never do, and it is an entry per operation
+        if (self.index is None):
+            self.index = {op.pc: op for op, length in zip(self.ops, self.lengths) if length > 0}
+        return self.index.get(address)
+
+    def bytes_at(self, op: AssemblerOperation, length: int) -> memoryview:
+        return self.view[op.pc:op.pc + length]
+
+    def contents(self):
+        """(op, bytes) of each operation, in source order"""
+        for op, length in zip(self.ops, self.lengths):
+            yield op, self.view[op.pc:op.pc + length]
+
+    def size(self) -> int:
+        return sum(self.lengths)
+
+    def segments(self) -> [(int, bytes)]:
+        """(address, bytes) of each run of code - a new one at each '.org' or jump in address"""
+        segments = []
+        for op, length in zip(self.ops, self.lengths):
+            if (op.operation == 'org' or (length > 0 and (not segments or segments[-1][0] + len(segments[-1][1]) != op.pc))):
+                segments.append((op.pc, bytearray()))
+            if (length > 0):
+                segments[-1][1].extend(self.bytes_at(op, length))
+        return [(address, bytes(data)) for address, data in segments]
+
+    def segment_table(self) -> [Segment]:
+        """
+        Each run of code - or of reserved space - in source order. A new one at each
+        jump in address (an '.org' gap) and each change between code and reserved space.
+        """
+        table = []      # [address, length, reserved]
+        for op, length in zip(self.ops, self.lengths):
+            if (length == 0):
+                continue
+            reserved = op.operation in self.RESERVED
+            if (table and table[-1][2] == reserved and table[-1][0] + table[-1][1] == op.pc):
+                table[-1][1] += length
+            else:
+                table.append([op.pc, length, reserved])
+        return [Segment(*segment) for segment in table]
+
+    def device_image(self, device: Device) -> 'ProgramImage':
+        """The operations placed in one memory device - an image sharing this one's memory"""
+        image = ProgramImage(device.start)
+        image.memory, image.view, image.used = self.memory, self.view, self.used
+        for op, length in zip(self.ops, self.lengths):
+            if (device.start <= op.pc < device.end):
+                image.ops.append(op)
+                image.lengths.append(length)
+        image.labels, image.errors, image.log = self.labels, self.errors, self.log
+        return image
+
+    def tobytes(self) -> bytes:
+        """The assembled bytes in source order - as in a .bin file"""
+        return b''.join(binarray for op, binarray in self.contents())
+
+
+class Assembler:
+    """
+    Single pass assembler core. Each operation is given its address, defines its
+    label and is encoded into the ProgramImage as it arrives from the parser. An
+    operation referring to a label we have not seen yet (a forward reference) gets
+    placeholder bytes and is recorded as a fixup - these are patched once, by
+    finish(), when the symbol table is complete.
+
+    Every symbol reference is also recorded as a Relocation - so the result can be
+    saved as an ObjectModule and linked with others by sap2link.py.
+
+    Operations which place no bytes (labels, comments, cpp linemarkers) are only
+    kept in the image for a listing - an '.org' is always kept, the hex writer needs it.
+
+    '.section' switches between the code, rodata and bss sections - each with its
+    own location counter. 'code' is placed as it arrives. Any other section that
+    does not start with an '.org' can only be placed once we know where everything
+    else ends - its operations are queued, and finish() lays it out after whatever
+    is already in its device (see DEVICES) - references to its labels are fixups
+    like any other forward reference.
+    """
+
+    class Section:
+        def __init__(self, name: str, device: str = None):
+            self.name = name
+            self.device = device
+            self.pc = None          # location counter while another section is current
+            self.queue = None       # operations waiting for finish() to lay the section out
+
+    def __init__(self, labels: dict, origin: int = 0, listing: bool = False, log = None):
+        self.labels = labels
+        self.listing = listing
+        self.log = log              # diagnostics - stdout if None
+        self.builder = Builder(labels, log)
+        self.pc = origin
+        self.section = self.Section('code')
+        self.sections = {}      # name -> Section of each section named by a '.section'
+        self.image = ProgramImage()
+        self.fixups = []        # position (in image.ops) of each operation waiting on a label
+        self.relocations = []   # Relocation of every symbol reference
+        self.imports = []       # labels left for the linker - see finish()
+        self.absolute = False   # an '.org' was seen - so the linker can not move this code
+
+    def emit(self, op: AssemblerOperation) -> None:
+        if (op.operation == 'section'):
+            self.switch(op.data, op.reg)
+        elif (self.section.queue is not None):
+            if (op.operation != 'org' or self.section.queue):
+                self.check_section(op)
+                self.section.queue.append(op)
+                return
+            self.section.queue = None       # starts with an '.org' - so can be placed now
+        self.check_section(op)
+        self.place(op)
+
+    def switch(self, name: str, device: str = None) -> None:
+        self.absolute = True
+        if (not self.sections):
+            self.sections['code'] = self.section    # everything before the first '.section' is code
+        self.section.pc = self.pc
+
+        section = self.sections.get(name)
+        if (section is None):
+            section = self.sections[name] = self.Section(name, device or SECTIONS[name])
+            section.queue = []
+        elif (device is not None and section.device is None):
+            section.device = device
+        elif (device is not None and device != section.device):
+            raise ImageError(f"section '{name}' is in {section.device} - not {device}")
+        self.section = section
+        if (section.queue is None):
+            self.pc = section.pc
+
+    def check_section(self, op: AssemblerOperation) -> None:
+        if (self.section.name == 'bss' and op.size > 0 and op.operation not in ProgramImage.RESERVED):
+            raise ImageError(f"only .ds space can go in bss - not '{op.operation}'")
+
+    def place(self, op: AssemblerOperation) -> None:
+        if (op.operation == 'org'):
+            self.pc = op.data.getRawData()
+            self.absolute = True
+
+        op.pc = self.pc
+        self.pc += op.size
+
+        if (op.operation == 'symbol'):
+            self.define_label(op)
+
+        data = self.reference(op)
+        if data is not None:
+            # The address (or its '<'/'>' byte) is always the tail of the instruction
+            kind = 'word' if data is op.data else 'low' if op.data.fnc == 'LOW' or op.data.fnc == '>' else 'high'
+            self.relocations.append(Relocation(op.pc + op.size - (2 if kind == 'word' else 1), kind, data.getRawData()))
+
+        if data is not None and data.getRawData() not in self.labels:
+            self.fixups.append(self.image.place(op, [0] * op.size))
+        else:
+            binarray = self.builder.build(op)
+            if (binarray or self.listing or op.operation == 'org'):
+                self.image.place(op, binarray)
+
+    def define_label(self, op: AssemblerOperation) -> None:
+        labelnm = op.data.getRawData()
+        if (labelnm in self.labels):
+            raise SymbolError(f"Replicated label '{labelnm}'")
+        self.labels[labelnm] = op.pc
+
+    def reference(self, op: AssemblerOperation) -> SymbolWordData:
+        """The symbol an operation refers to - or None (a label definition is not a reference)"""
+        data = op.data.data if isinstance(op.data, FunctionData) else op.data
+        return data if isinstance(data, SymbolWordData) and op.operation != 'symbol' else None
+
+    def layout(self) -> None:
+        """Place each queued section - after everything already in its device, in the order the sections were named"""
+        code = self.sections.get('code')
+        if (code is None):
+            return
+        code_pc = self.pc if self.section is code else code.pc
+        code_device = code.device or next((device.name for device in DEVICES.values() if device.start <= code_pc < device.end), 'ram')
+        for section in self.sections.values():
+            if (section.queue is None):
+                continue
+            device = DEVICES[section.device or code_device]
+            self.section.pc = self.pc
+            self.section = section
+            self.pc = max([op.pc + length for op, length in zip(self.image.ops, self.image.lengths)
+                                if length > 0 and device.start <= op.pc < device.end], default = device.start)
+            queue, section.queue = section.queue, None
+            for op in queue:
+                try:
+                    self.place(op)
+                except (SymbolError, ImageError) as e:
+                    self.builder.errors += 1
+                    print(f"Assembler **FAILED** on Line {op.source_line} '{op.source_file}' {e}", file = self.log)
+            if (self.pc > device.end):
+                self.builder.errors += 1
+                print(f"Assembler **FAILED** section '{section.name}' ends at 0x{self.pc:04x} - past the end of {device.name}", file = self.log)
+
+    def finish(self, imports: bool = False) -> None:
+        """
+        Lay out any queued sections, then patch the fixups - any label still undefined
+        is reported by the Builder. When building an ObjectModule ('imports' True) they
+        are imports instead - encoded as address 0 for sap2link to patch.
+        """
+        self.layout()
+        if (imports):
+            referenced = {self.reference(self.image.ops[position]).getRawData() for position in self.fixups}
+            self.imports = sorted(referenced - self.labels.keys())
+            self.labels.update(dict.fromkeys(self.imports, 0))
+
+        for position in self.fixups:
+            op = self.image.ops[position]
+            self.image.write(position, self.builder.build(op))
+        self.fixups = []
+
+        for labelnm in self.imports:
+            del self.labels[labelnm]
+
+    def object_module(self, name: str) -> 'ObjectModule':
+        return ObjectModule(name, not self.absolute, self.image.segments(),
+                            dict(self.labels), list(self.imports), list(self.relocations))
+
+
+class Relocation(NamedTuple):
+    address: int        # of the bytes to patch
+    kind: str           # 'word' (little endian) or the 'low'/'high' byte
+    symbol: str
+
+
+@dataclass
+class ObjectModule:
+    """
+    An assembled module - as written by 'assembler.py -o' and read by sap2link.py.
+    A relocatable module (no '.org') is assembled from address 0 - the linker
+    decides where it goes, so its segment, export and relocation addresses are
+    relative to that. Saved as JSON.
+    """
+    FORMAT = 'sap2-object'
+    VERSION = 1
+
+    name: str
+    relocatable: bool
+    segments: list          # (address, bytes)
+    exports: dict           # label -> address
+    imports: list           # labels defined by other modules
+    relocations: list       # Relocation
+
+    def size(self) -> int:
+        return max((address + len(data) for address, data in self.segments), default = 0)
+
+    def save(self, path: str) -> None:
+        contents = {'format': self.FORMAT, 'version': self.VERSION,
+                    'name': self.name, 'relocatable': self.relocatable,
+                    'segments': [[address, data.hex()] for address, data in self.segments],
+                    'exports': self.exports, 'imports': self.imports,
+                    'relocations': [list(relocation) for relocation in self.relocations]}
+        with open(path, 'w') as f:
+            json.dump(contents, f, indent = 1)
+
+    @classmethod
+    def load(cls, path: str) -> 'ObjectModule':
+        with open(path, 'r') as f:
+            contents = json.load(f)
+        if (contents.get('format') != cls.FORMAT or contents.get('version') != cls.VERSION):
+            raise ImageError(f"'{path}' is not a version {cls.VERSION} SAP2 object file")
+        return cls(contents['name'], contents['relocatable'],
+                   [(address, bytes.fromhex(data)) for address, data in contents['segments']],
+                   contents['exports'], contents['imports'],
+                   [Relocation(*relocation) for relocation in contents['relocations']])
+
+
+# LogiSim/binary output files - each serialized from a ProgramImage
+
+def produceBinFile(binName: str, image: ProgramImage) -> int:
+    # Reserved space is a seek - a hole in the file, read back as zeros
+    with open(binName, "wb") as file:
+        for segment in image.segment_table():
+            if (segment.reserved):
+                file.seek(segment.length, os.SEEK_CUR)
+            else:
+                file.write(image.view[segment.address:segment.address + segment.length])
+        size = file.tell()
+        file.truncate()     # the file still ends at 'size' if the last segment was a hole
+    return size
+
+
+
+def produceV2HexFile(binName: str, image: ProgramImage) -> int:
+    # No addresses in a v2 file - so reserved space is run length encoded ('200*00')
+    size = 0
+    with logisim.open_memory_file(binName, logisim.V2_HEADER) as file:
+        code = []
+        for segment in image.segment_table():
+            if (segment.reserved):
+                file.byte_rows(b''.join(code), 8)
+                file.write(f"{segment.length}*00\n")
+                code = []
+            else:
+                code.append(image.view[segment.address:segment.address + segment.length])
+            size += segment.length
+        file.byte_rows(b''.join(code), 8)
+        file.write("\n")
+    return size
+
+
+def produceV3HexFile(binName: str, image: ProgramImage, addrOffset: int  = None, log = None) -> int:
+
+    addrOffset = image.offset if addrOffset is None else addrOffset
+
+    totalsize = 0
+    lastaddrfromORG = -1
+    bytecountfromORG = 0
+    run = None              # [address, bytecountfromORG, length] - contiguous bytes still to be written
+    skipped = False         # reserved space was skipped - the next bytes need their address, as after an ORG
+    warned = False
+
+    # Addresses below the offset are written as they are - headers and continuation rows alike
+    def file_address(address):
+        return address - (addrOffset if addrOffset <= address else 0)
+
+    def write_run(address, bytecount, length):
+        # A line break goes in before every byte whose count (from the ORG) is 31 mod 32
+        data = image.view[address:address + length]
+        start = 0
+        for linebreak in range(31 - bytecount % 32, len(data), 32):
+            file.bytes(data[start:linebreak])
+            file.write(f"\n{file_address(address + linebreak):04x}: ")
+            start = linebreak
+        file.bytes(data[start:])
+
+    with logisim.open_memory_file(binName, logisim.V3_HEADER) as file:
+        for op,binarray in image.contents():
+            sz = len(binarray)
+            totalsize += sz
+
+            address = op.pc
+
+            if (sz > 0 and op.operation in image.RESERVED):
+                skipped = True
+                continue
+
+            if (address != lastaddrfromORG) and \
+                (op.operation == 'org' or ((lastaddrfromORG == -1 or skipped) and sz > 0)):
+
+                if (run is not None):
+                    write_run(*run)
+                    run = None
+                bytecountfromORG = 0
+                lastaddrfromORG = address
+                skipped = False
+                if (addrOffset > address and not warned):
+                    print("***WARNING*** address mismatch on assembling. Please check ORG directives - if assembling for RAM. Ignoring base address offset..", file = log)
+                    warned = True
+                file.write(f"\n{file_address(address):04x}: ")
+
+            if (sz > 0):
+                if (run is not None and run[0] + run[2] == address and (addrOffset <= run[0]) == (addrOffset <= address)):
+                    run[2] += sz
+                else:
+                    if (run is not None):
+                        write_run(*run)
+                    run = [address, bytecountfromORG, sz]
+                bytecountfromORG += sz
+
+        if (run is not None):
+            write_run(*run)
+        file.write("\n")
+    return totalsize
+
+
+class BasicBlock(NamedTuple):
+    address: int
+    label: str              # at the start of the block - None if it is entered by falling through
+    instructions: int
+    tstates: int            # for one pass through the block
+    unknown: int            # instructions with no microcode - so not in 'tstates'
+    target: int             # where its last instruction jumps to - None if it does not
+
+
+def instruction_at(op: AssemblerOperation, binarray) -> isa.Instruction:
+    """The instruction an operation assembled to - None for directives, labels and data"""
+    if (len(binarray) == 0 or op.operation not in isa.instruction_set().encoding):
+        return None
+    return isa.instruction_set().decode[binarray[0]]
+
+
+def basic_blocks(image: ProgramImage) -> [BasicBlock]:
+    """
+    Straight line runs of instructions, in source order. A block starts at a label,
+    an '.org' or after data, and ends with a jump, call, djnz, ret or hlt. The image
+    needs the labels - as kept for a listing.
+    """
+    blocks = []
+    block = None            # [address, label, instructions, tstates, unknown]
+    label = None
+    for op, binarray in image.contents():
+        if (op.operation in ('symbol', 'org')):
+            if (block is not None):
+                blocks.append(BasicBlock(*block, None))
+                block = None
+            label = op.data.getRawData() if op.operation == 'symbol' else None
+            continue
+        instruction = instruction_at(op, binarray)
+        if (instruction is None):
+            if (block is not None and len(binarray) > 0):
+                blocks.append(BasicBlock(*block, None))
+                block = None
+            continue
+
+        if (block is None):
+            block = [op.pc, label, 0, 0, 0]
+            label = None
+        block[2] += 1
+        block[3] += instruction.tstates or 0
+        block[4] += instruction.tstates is None
+        flow = instruction.flow()
+        if (flow != isa.NEXT):
+            target = binarray[-2] | binarray[-1]<<8 if flow != isa.STOP else None
+            blocks.append(BasicBlock(*block, target))
+            block = None
+    if (block is not None):
+        blocks.append(BasicBlock(*block, None))
+    return blocks
+
+
+def produceListing(image: ProgramImage, dissassembler: Dissassembler = None, tstates: bool = False) -> [str]:
+    """
+    The -c listing - address, bytes and dissassembly of each operation that has bytes.
+    With 'tstates' each instruction also gets its T states (from the microcode - see
+    isa.py) and a running total since the last label, and the listing ends with a
+    summary of the T states of each basic block.
+    """
+    dissassembler = dissassembler or Dissassembler()
+    if (not tstates):
+        return [f'{op.pc:04X}\t{binarray[:128].hex().upper()}\t{dissassembler.dissassemble(op)}'
+                    for op,binarray in image.contents() if len(binarray) > 0]
+
+    lines = []
+    running = 0
+    for op, binarray in image.contents():
+        if (op.operation == 'symbol'):
+            lines.append(f':{op.data.getRawData()}')
+            running = 0
+        if (len(binarray) == 0):
+            continue
+        line = f'{op.pc:04X}\t{binarray[:128].hex().upper()}\t{dissassembler.dissassemble(op)}'
+        instruction = instruction_at(op, binarray)
+        if (instruction is not None):
+            running += instruction.tstates or 0
+            line = f'{line:32}\t; T{instruction.tstates or "?":<3} {running:6}'
+        lines.append(line)
+
+    names = {}
+    for op in image.ops:
+        if (op.operation == 'symbol'):
+            names.setdefault(op.pc, op.data.getRawData())
+    lines += ['', 'Basic blocks - T states for one pass:']
+    for block in basic_blocks(image):
+        exit = ''
+        if (block.target is not None):
+            exit = f"-> {block.target:04X} {names.get(block.target, '')}".rstrip()
+            if (block.target <= block.address):
+                exit += ' (loop)' if block.target == block.address else ' (back)'
+            if (image.used[block.target] and image.op_at(block.target) is None):
+                exit += ' (mid-instruction)'
+        unknown = f' +{block.unknown}?' if block.unknown else ''
+        lines.append(f"  {block.address:04X} {block.label or '':16} {block.instructions:4} instructions  T{block.tstates}{unknown:6} {exit}".rstrip())
+    return lines
+
+
+def outputImages(image: ProgramImage, basename: str, addrOffset: int, sectioned: bool = False) -> [(str, ProgramImage, int)]:
+    """
+    (basename, image, address offset) of each image to write. Once a program uses
+    '.section' that is one per memory device - 'example.rom' and 'example.ram' - each
+    addressed from the start of its device. A device with no code or data (eg. only
+    bss) gets no image.
+    """
+    if (not sectioned):
+        return [(basename, image, addrOffset)]
+    images = [(f"{basename}.{device.name}", image.device_image(device), device.start) for device in DEVICES.values()]
+    return [(name, device_image, offset) for name, device_image, offset in images
+                if any(not segment.reserved for segment in device_image.segment_table())]
+
+
+def output_basename(source_file: str) -> str:
+    """Output files are named after the source - less its extension ('./x.asm' -> './x', 'dir.v2/x.asm' -> 'dir.v2/x')"""
+    return os.path.splitext(source_file)[0]
+
+
+def outputFilenames(basename: str, outTypes: [OutputType]) -> dict:
+    return {OutputType.BINARY: basename + ".bin",
+            OutputType.RAWHEX: basename + (".v2.hex" if OutputType.ADDRESSEDHEX in outTypes else ".hex"),
+            OutputType.ADDRESSEDHEX: basename + ".hex"}
+
+
+def produceDepFile(depName: str, targets: [str], sources: [str]) -> None:
+    """A make (or ninja) dependency file - the targets depend on every source which fed them"""
+    # As gcc -MD does - make would otherwise split a name at a space, start a comment at '#' and expand '$'
+    escape = lambda path: path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+    rule = [' '.join(escape(target) for target in targets) + ':'] + [escape(source) for source in sources]
+    with open(depName, 'w') as f:
+        f.write(' \\\n  '.join(rule) + '\n')
+
+
+def produceOutputFile(outType: OutputType, binName: str, image: ProgramImage, addrOffset: int = None, log = None) -> int:
+    """Write one output file - atomically, so a simulator (or --watch) never sees half a file"""
+    tmp = f'{binName}.{os.getpid()}.tmp'
+    try:
+        if (outType == OutputType.BINARY):
+            size = produceBinFile(tmp, image)
+        elif (outType == OutputType.RAWHEX):
+            size = produceV2HexFile(tmp, image)
+        elif (outType == OutputType.ADDRESSEDHEX):
+            size = produceV3HexFile(tmp, image, addrOffset, log)
+        else:
+            raise Exception('Output type is not defined')
+        os.replace(tmp, binName)
+    finally:
+        # Only still there if writing failed - don't leave it behind
+        if (os.path.exists(tmp)):
+            os.remove(tmp)
+    return size
+
+
 class ParseError(Exception):
         def __init__(self,msg):
             self.msg = msg
@@ -551,24 +1157,61 @@ class ParserDefinitionError(Exception):
             return f"**ParserDefinitionError**: {self.msg}"
 
 class ParserException(Exception):
-        def __init__(self,msg):
+        # 'fatal' - the line is wrong, not just this rule - so it is reported rather than backtracked
+        def __init__(self,msg, fatal: bool = False):
             self.msg = msg
+            self.fatal = fatal
 
         def __str__(self):
             return f"**ParserException**: {self.msg}"
 
+class Token(NamedTuple):
+    kind : str
+    text : str
+    start : int
+    end : int
+
+
 class BaseParser(ABC):
 
-    def __init__(self):
+    # Tokens are produced in a single pass over a line by one compiled regex.
+    # Each named group is a token kind - 'ws' is skipped.
+    # Words are classified by looking them up in KEYWORDS (default 'symbol')
+    TOKEN_RE = re.compile(rf"(?P<ws>[{WSPACE}]+)|(?P<symbol>\w+)|(?P<punctuation>.)")
+    KEYWORDS = {}
+
+    def __init__(self, packrat: bool = False):
+        self.log = None             # diagnostics - stdout if None
         self._cache = dict()
+        self._memo = dict() if packrat else None
+        self.memo_hits = 0
+        self.memo_misses = 0
 
     def __str__(self):
-        return f"<{self.text}> pos:{self.pos} out of {self.len} current <{self.text[self.pos:]}>"
+        return f"<{self.text}> pos:{self.pos} out of {self.len} current <{self.current()}>"
 
     def init(self,text) -> None:
         self.text = text
+        self.tokens = self.tokenize(text)
         self.pos = 0
-        self.len = len(text)
+        self.len = len(self.tokens)
+        if (self._memo is not None):
+            self._memo.clear()
+
+    def tokenize(self, text: str) -> [Token]:
+        tokens = []
+        keywords = self.KEYWORDS
+        for m in self.TOKEN_RE.finditer(text):
+            kind = m.lastgroup
+            if kind == 'ws':
+                continue
+            tok = m.group()
+            if kind == 'symbol':
+                kind = keywords.get(tok, kind)
+                # Mnemonics, registers and labels recur line after line - share one string for each
+                tok = sys.intern(tok)
+            tokens.append(Token(kind, tok, m.start(), m.end()))
+        return tokens
 
     @abstractmethod
     def start(self) -> None:
@@ -579,30 +1222,27 @@ class BaseParser(ABC):
         raise ParserDefinitionError("Abstract Function 'parse' needs to overrriden")
 
     def current(self) -> str:
-        return self.text[self.pos:]
-
-    def gobblewhitespace(self) -> None:
-        while self.pos < self.len and self.text[self.pos] in WSPACE:
-            self.pos += 1
+        return self.text[self.tokens[self.pos].start:] if self.pos < self.len else ''
 
     def eof(self) -> bool:
-        return self.pos == self.len
+        return self.pos >= self.len
+
+    def peek(self) -> Token:
+        return self.tokens[self.pos] if self.pos < self.len else None
 
     def next(self) -> str:
-        chars = []
-        self.gobblewhitespace()
-        while self.pos < self.len and self.text[self.pos] not in WSPACE :
-            chars.append(self.text[self.pos])
-            self.pos += 1
-        return ''.join(chars)
+        tok = self.peek()
+        if tok is None:
+            return ''
+        self.pos += 1
+        return tok.text
 
     def match(self, wantedtok: str) -> str:
-        lentoken = len(wantedtok)
-        nxt = self.text[self.pos:(self.pos + lentoken)]
-        if (nxt != wantedtok):
+        tok = self.peek()
+        if (tok is None or tok.text != wantedtok):
             raise ParseError('COULD NOT MATCH')
-        self.pos = self.pos + lentoken
-        return nxt
+        self.pos += 1
+        return tok.text
 
 
     def wanted(self, wantedtok: str) -> str:
@@ -612,25 +1252,31 @@ class BaseParser(ABC):
             return None
 
     def trymatch(self,*wantedtoks,**opts) -> str:
-        self.gobblewhitespace()
-        z = list(wantedtoks)
-        z.sort(key = lambda e: len(e),reverse=True)
-        #print(z)
-        for tok in z:
-            caughttok = self.wanted(tok)
-            if (caughttok != None):
-                if 'whitespace' in opts:
-                    if opts['whitespace']:
-                        ch = self.text[self.pos]
-                        if not (ch == ' ' or ch == '\t'):
-                            print(f"Parser Error. Expected whitespace but got <{ch}>")
-                            return None
-
-                self.gobblewhitespace()
-                return caughttok
+        tok = self.peek()
+        if tok is not None and tok.text in wantedtoks:
+            if opts.get('whitespace'):
+                ch = self.text[tok.end]
+                if not (ch == ' ' or ch == '\t'):
+                    print(f"Parser Error. Expected whitespace but got <{ch}>", file = self.log)
+                    return None
+            self.pos += 1
+            return tok.text
+
+        return None
 
+    def peek_token(self, *kinds) -> Token:
+        tok = self.peek()
+        if tok is not None and tok.kind in kinds:
+            return tok
         return None
 
+    def token(self, *kinds) -> str:
+        tok = self.peek_token(*kinds)
+        if tok is None:
+            raise ParserException(f"Parser.token Expected {'/'.join(kinds)} but got <{self.current()}>")
+        self.pos += 1
+        return tok.text
+
 
     def produce_chars_pattern(self, pattern: str) -> str:
 
@@ -673,30 +1319,31 @@ class BaseParser(ABC):
 
         return ''.join(list(wanted))
 
-    def peek_chars(self, pattern: str, dont_gobble:bool=False) -> str:
-
-        try:
-            return self.chars(pattern, dont_gobble = dont_gobble)
-        except ParserException as e:
-            # We have not found a char match - so go back and check other rules/token matches
-            return None
-        except IndexError as e:
-            # Arrived here from 'chars' function - 'ch = self.text[self.pos]'
-            # -  exhausted parsing our current line of text
-            return None
+    def peek_chars(self, pattern: str) -> str:
+        # No match is not an error here - go back and check other rules/token matches
+        return self.match_chars(pattern)
 
-    def chars(self, pattern: str, bump: bool = True, dont_gobble:bool=False) -> str:
-        if (not dont_gobble):
-            self.gobblewhitespace()
+    # Single character (punctuation) tokens - such as ',' '(' ':'
+    def chars(self, pattern: str, bump: bool = True) -> str:
+        ch = self.match_chars(pattern, bump)
+        if ch is None:
+            tok = self.peek()
+            raise ParserException(f"Parser.chars Expected {pattern} but got " + ("end of line" if tok is None else f"<{tok.text}>"))
+        return ch
 
+    def match_chars(self, pattern: str, bump: bool = True) -> str:
+        """The next token if it is a single character in 'pattern' - None if not"""
         if (pattern not in self._cache):
             self._cache[pattern] = self.produce_chars_pattern(pattern)
-        ch = self.text[self.pos]
-        if ch in self._cache[pattern]:
+        tok = self.peek()
+        if tok is None:
+            return None
+        ch = tok.text
+        if len(ch) == 1 and ch in self._cache[pattern]:
             if (bump):
                 self.pos += 1
             return ch
-        raise ParserException(f"Parser.chars Expected {pattern} but got <{ch}>")
+        return None
 
 
     # Perhaps - get rid of this - and replace with 'try_function_rules'
@@ -704,46 +1351,178 @@ class BaseParser(ABC):
     # just saves us having to preindex names with 'self.'
 
     def try_rules(self,*rules):
-        self.gobblewhitespace()
 
         for rule in rules:
+            rv = self.apply_rule(rule)
+            if (rv is not None):
+                return rv
+
+    # Evaluate a single rule at the current token, rewinding if it fails.
+    # With packrat memoization enabled the result (and where it left us) is
+    # cached against (rule, position) - so within a line no rule is ever
+    # evaluated twice at the same offset.
+
+    def apply_rule(self, name: str, rule = None):
+        start = self.pos
+        memo = self._memo
+        if (memo is None):
             try:
-                rv = getattr(self, rule)()
-                if (rv is not None):
-                    return rv
+                rv = (rule or getattr(self, name))()
             except ParserException as e:
-                pass
+                if (e.fatal):
+                    raise
+                rv = None
+            if (rv is None):
+                self.pos = start
+            return rv
+
+        key = (name, start)
+        if (key in memo):
+            self.memo_hits += 1
+            rv, self.pos = memo[key]
+            return rv
+        self.memo_misses += 1
+
+        try:
+            rv = (rule or getattr(self, name))()
+        except ParserException as e:
+            if (e.fatal):
+                raise
+            rv = None
+        if (rv is None):
+            self.pos = start
+        memo[key] = (rv, self.pos)
+        return rv
+
+    def memo_stats(self) -> (int, int):
+        """Packrat cache (hits, lookups) since the parser was created"""
+        return self.memo_hits, self.memo_hits + self.memo_misses
+
+    # Jump straight to a rule from a prebuilt table, keyed by a token kind or
+    # its text, rather than trying each rule in turn.
+
+    def bind_rules(self, table: dict) -> dict:
+        return {key: getattr(self, rule) for key, rule in table.items()}
+
+    def dispatch(self, rules: dict, key: str):
+        rule = rules.get(key)
+        if (rule is not None):
+            return self.apply_rule(rule.__name__, rule)
 
     def try_function_rules(self,*rules):
-        self.gobblewhitespace()
 
         for rule in rules:
-            try:
-                rv = rule()
-                if (rv is not None):
-                    return rv
-            except ParserException as e:
-                pass
+            rv = self.apply_rule(rule.__name__, rule)
+            if (rv is not None):
+                return rv
 
     def finish_parsing(self):
         self.pos = self.len + 1
 
 
 class AssemblerParser(BaseParser):
-    def __init__(self, symbolTable):
-        super().__init__()
+
+    TOKEN_RE = re.compile(rf"""
+         (?P<ws>[{WSPACE}]+)
+        |(?P<comment>;.*)
+        |(?P<cpp>\#.*)
+        |(?P<string>'[^']*')
+        |(?P<number>(?:0b[01]+|0x[0-9A-Fa-f]+|0o[0-7]+|[+-]?[0-9]+)(?!\w))
+        |(?P<symbol>\w+)
+        |(?P<punctuation>.)
+        """, re.VERBOSE)
+
+    # Statement rules indexed by the leading token's kind (or text for punctuation)
+    STATEMENT_RULES = {
+        'cpp' : 'cpp_directive',
+        'comment' : 'comment',
+        ':' : 'symbol',
+        '.' : 'directive',
+        'mnemonic' : 'instruction',
+    }
+
+    DIRECTIVE_RULES = {
+        'org' : 'org', 'end' : 'end',
+        'db' : 'db', 'dw' : 'dw', 'ds' : 'ds', 'dt' : 'dt',
+        'fill' : 'fill', 'incbin' : 'incbin', 'section' : 'section',
+    }
+
+    # Instruction rules indexed by mnemonic - whole word tokens, so 'mov', 'movi'
+    # and 'movwi' are simply different keys.
+    INSTRUCTION_RULES = {
+        'movwi' : 'movwi',
+        **dict.fromkeys(['movi','addi','subi','andi','ori','xori'], 'intermediate8'),
+        **dict.fromkeys(['mov','add','sub','and','or','xor','swp'], 'reg8'),
+        **dict.fromkeys(['ld','st'], 'ld'),
+        **dict.fromkeys(['call','jmp','jpz','jpnz','jpc','jpnc','jps','jpns','jpv','jpnv'], 'call'),
+        **dict.fromkeys(['inc','dec'], 'singlebyte'),
+        **dict.fromkeys(['exx','pushall','popall','ret','nop','hlt','clc','setc'], 'singleop'),
+        **dict.fromkeys(['out','shl','shr','csp'], 'out'),
+        **dict.fromkeys(['pop','push'], 'pushpop'),
+        'djnz' : 'djnz',
+    }
+
+    KEYWORDS = {
+        **dict.fromkeys(INSTRUCTION_RULES, 'mnemonic'),
+        **dict.fromkeys(['r0','r1','r2','r3','R0','R1','R2','R3','sp'], 'register'),
+    }
+
+    REGISTERS = {'r0':0, 'r1':1, 'r2':2, 'r3':3, 'R0':0, 'R1':1, 'R2':2, 'R3':3}
+
+    # cpp linemarker - '# <line> "<file>" <flags>'
+    CPP_LINEMARKER_RE = re.compile(r'\s*([+-]?[0-9]+)(?:\s*"([\w.<>/\s-]+)")?')
+
+    # Characters allowed within a .dt 'string'
+    DT_STRING_RE = re.compile(r"[A-Za-z0-9_@().!*\[\]+# -]+")
+
+    def __init__(self, symbolTable, packrat: bool = False, line_cache_size: int = 4096):
+        super().__init__(packrat)
         self.symbolTable = symbolTable
+        # LRU of line text -> template operations. Macro expanded sources repeat
+        # the same lines many times - each repeat is a cheap copy of the template.
+        # Symbols still resolve lazily through the shared symbolTable.
+        self._lines = OrderedDict() if line_cache_size > 0 else None
+        self.line_cache_size = line_cache_size
+        self.line_hits = 0
+        self.line_misses = 0
+        self._statement_rules = self.bind_rules(self.STATEMENT_RULES)
+        self._directive_rules = self.bind_rules(self.DIRECTIVE_RULES)
+        self._instruction_rules = self.bind_rules(self.INSTRUCTION_RULES)
 
 
     def parse(self, text):
 
+        lines = self._lines
+        if (lines is not None):
+            template = lines.get(text)
+            if (template is not None):
+                lines.move_to_end(text)
+                self.line_hits += 1
+                return [op.clone() for op in template]
+            self.line_misses += 1
+
+        allops = self.parse_text(text)
+
+        if (lines is not None):
+            lines[text] = [op.clone() for op in allops]
+            if (len(lines) > self.line_cache_size):
+                lines.popitem(last = False)
+        return allops
+
+    def line_cache_stats(self) -> (int, int):
+        """Line cache (hits, lookups) since the parser was created"""
+        return self.line_hits, self.line_hits + self.line_misses
+
+    def parse_text(self, text):
+
         super().init(text)
         self.start()
         allops = []
 
         while (self.pos < self.len):
 
-            rv = self.try_rules('cpp_directive','comment', 'symbol', 'directive', 'instruction')
+            tok = self.tokens[self.pos]
+            rv = self.dispatch(self._statement_rules, tok.kind if tok.kind != 'punctuation' else tok.text)
 
             if (rv is None):
                 raise ParserException(f"Can not parse {self.text}")
@@ -762,35 +1541,30 @@ class AssemblerParser(BaseParser):
     # Top rules
     # CPP directive - allows us to use the generic C preprocessor - such as cpp
     def cpp_directive(self) -> AssemblerOperation:
-        if self.peek_chars('#'):
-            #print("cpp_directive",self)
-            data = self.text[self.pos:]
-            number = self.try_rules('decnumber')
-            if (number is not None):
+        if self.peek_token('cpp'):
+            data = self.next()[1:]
+            marker = self.CPP_LINEMARKER_RE.match(data)
+            if (marker is not None):
                 # try and extract file source name or cpp function
-                self.gobblewhitespace()
-                if (self.chars('"')):
-                    fName = self.cpp_str()  #At this point we've either read in a file name
-                                            # or a CPP function type
-                    self.chars('"')
-                    # ignore everything else - after the trailing quote
-                    self.finish_parsing()
-                    # check to see if this is not some built-in definition.
-                    if (not fName.startswith("<")):
-                        return AssemblerOperation(operation = 'cppline', data = data, source_file = fName, source_line = number - 1 , size = 0)
-
-                #self.finish_parsing()
+                if (marker.group(2) is None):
+                    raise ParserException(f"Expected file name in cpp line marker <{data}>")
+                number = int(marker.group(1))
+                fName = ''.join(marker.group(2).split())  #At this point we've either read in a file name
+                                                          # or a CPP function type
+                # ignore everything else - after the trailing quote
+                # check to see if this is not some built-in definition.
+                if (not fName.startswith("<")):
+                    return AssemblerOperation(operation = 'cppline', data = data, source_file = fName, source_line = number - 1 , size = 0)
+
                 return AssemblerOperation(operation = 'cppbuiltin',size = 0, data=data)
 
-            self.finish_parsing()
             return AssemblerOperation(operation = 'comment',data = data , size = 0)
 
 
     def comment(self) -> AssemblerOperation:
         """If we spot a comment TOKEN - then save text up to EOL and finish off parsing the line"""
-        if self.peek_chars(';'):
-            data = self.text[self.pos:]
-            self.pos = self.len + 1
+        if self.peek_token('comment'):
+            data = self.next()[1:]
             return AssemblerOperation(operation = 'comment',data = data , size = 0)
 
 
@@ -801,13 +1575,15 @@ class AssemblerParser(BaseParser):
 
     def directive(self) -> AssemblerOperation:
         if (self.peek_chars(".")):
-            return self.try_rules('org','end','db','dw','ds','dt')
+            tok = self.peek()
+            return self.dispatch(self._directive_rules, tok.text if tok is not None else None)
 
 
 
     def instruction(self) -> AssemblerOperation:
-        return self.try_rules('movwi','intermediate8','reg8','ld',\
-                            'call','singlebyte','singleop','out','pushpop','djnz')
+        tok = self.peek_token('mnemonic')
+        if (tok is not None):
+            return self.dispatch(self._instruction_rules, tok.text)
 
 
     # Directive operations
@@ -820,35 +1596,81 @@ class AssemblerParser(BaseParser):
         if (self.trymatch('end')):
             return AssemblerOperation(operation ='end', size = 0)
 
+    # '.db 1,2,3' and '.dw 0x1234,0x5678' lists become a single operation - holding all of their bytes
+
     def dw(self) -> AssemblerOperation:
         if (self.trymatch('dw')):
-            return AssemblerOperation(operation = 'dw', data = self.number16bit(), size = 2)
+            data = self.number16bit()
+            if (not self.peek_chars(',')):
+                return AssemblerOperation(operation = 'dw', data = data, size = 2)
+            values = self.number_list(data, 'number16bit')
+            return AssemblerOperation(operation = 'dw', data = BytesData(b''.join(value.to_bytes(2, 'little') for value in values)),
+                                      size = 2 * len(values))
 
     def db(self) -> AssemblerOperation:
         if (self.trymatch('db')):
-            return AssemblerOperation(operation = 'db', data = self.number8bit(), size = 1)
+            data = self.number8bit()
+            if (not self.peek_chars(',')):
+                return AssemblerOperation(operation = 'db', data = data, size = 1)
+            values = self.number_list(data, 'number8bit')
+            return AssemblerOperation(operation = 'db', data = BytesData(values), size = len(values))
+
+    def number_list(self, first: Data, rule: str) -> [int]:
+        """The values of a list whose first value and ',' have been read"""
+        values = [first]
+        while True:
+            values.append(self.try_rules(rule))
+            if (not self.peek_chars(',')):
+                break
+        if (None in values):
+            raise ParserException(f"Expected a list of numbers but got <{self.text}>")
+        return [value.getRawData() & (0xff if rule == 'number8bit' else 0xffff) for value in values]
+
+    def fill(self) -> AssemblerOperation:
+        """.fill count[,value] - 'count' bytes of 'value' (0 if not given)"""
+        if (self.trymatch('fill')):
+            count = self.number16bit()
+            value = self.number8bit() if self.peek_chars(',') else ByteData(0)
+            if (count is None or value is None):
+                raise ParserException(f"Expected .fill count,value but got <{self.current()}>")
+            size = self.space_size(count, 'fill')
+            return AssemblerOperation(operation = 'fill', data = BytesData(bytes(value.getData()) * size), size = size)
+
+    def space_size(self, count: Data, directive: str) -> int:
+        """The byte count of a '.fill' or '.ds' - it can not be negative or run past the 64K address space"""
+        size = count.getRawData()
+        if (size < 0 or size > ProgramImage.SIZE):
+            raise ParserException(f".{directive} of {size} bytes in <{self.text}> - expected 0 to {ProgramImage.SIZE}", fatal = True)
+        return size
+
+    def section(self) -> AssemblerOperation:
+        """.section code|rodata|bss[,rom|ram] - 'reg' holds the device, if given"""
+        if (self.trymatch('section')):
+            name = self.token('symbol')
+            if (name not in SECTIONS):
+                raise ParserException(f"Unknown section '{name}' - expected {'/'.join(SECTIONS)}", fatal = True)
+            device = self.token('symbol') if self.peek_chars(',') else None
+            if (device is not None and device not in DEVICES):
+                raise ParserException(f"Unknown memory device '{device}' - expected {'/'.join(DEVICES)}", fatal = True)
+            return AssemblerOperation(operation = 'section', data = name, reg = device, size = 0)
+
+    def incbin(self) -> AssemblerOperation:
+        """.incbin 'file' - the size is only known once the SourceParser has read the file"""
+        if (self.trymatch('incbin')):
+            return AssemblerOperation(operation = 'incbin', data = FileData(self.token('string')[1:-1]), size = 0)
 
     def ds(self) -> AssemblerOperation:
         if (self.trymatch('ds')):
-            return AssemblerOperation(operation = 'ds', data =  0, size = self.number16bit().getRawData())
+            count = self.number16bit()
+            if (count is None):
+                raise ParserException(f"Expected .ds count but got <{self.current()}>")
+            return AssemblerOperation(operation = 'ds', data =  0, size = self.space_size(count, 'ds'))
 
     def dt(self) -> AssemblerOperation:
         if (self.trymatch('dt')):
-            strmatch = 'A-Za-z0-9_@().!*[]//-+# '
-            astr = []
-            self.chars("'")
-
-            ch = self.chars(strmatch, dont_gobble = True)
-            astr.append(ch)
-
-            while True:
-                ch = self.peek_chars(strmatch, dont_gobble = True)
-                if (ch is None):
-                    break
-                astr.append(ch)
-
-            self.chars("'")
-            fstr = ''.join(astr)
+            fstr = self.token('string')[1:-1]
+            if (not self.DT_STRING_RE.fullmatch(fstr)):
+                raise ParserException(f"Unsupported characters in string '{fstr}'")
             return AssemblerOperation(operation = 'dt', data = StringData(fstr), size = len(fstr) + 1)
 
 
@@ -885,7 +1707,7 @@ class AssemblerParser(BaseParser):
                 regp = self.try_rules('registers16')
                 self.chars(')')
                 # SMELLY!
-                return AssemblerOperation(operation = "i" + op, reg =  regl, regr = regp, size = 1)
+                return AssemblerOperation(operation = sys.intern("i" + op), reg =  regl, regr = regp, size = 1)
             else:
                 data = self.try_rules('number16bit','symbolstr')
                 return AssemblerOperation(operation = op, reg =  regl, data = data, size = 3)
@@ -906,7 +1728,7 @@ class AssemblerParser(BaseParser):
         if (op is not None):
             reg = self.try_rules('registers','registers16')
             #SMELLY
-            return AssemblerOperation(operation = op if isinstance(reg,int) else op+reg, reg = reg, size = 1)
+            return AssemblerOperation(operation = op if isinstance(reg,int) else sys.intern(op+reg), reg = reg, size = 1)
         return None
 
     def singleop(self) -> AssemblerOperation:
@@ -927,7 +1749,7 @@ class AssemblerParser(BaseParser):
         op = self.trymatch('pop','push')
         if (op is not None):
             reg = self.try_rules('registers')
-            return AssemblerOperation(operation = op+'r'+str(reg), reg = reg,  size = 1)
+            return AssemblerOperation(operation = sys.intern(op+'r'+str(reg)), reg = reg,  size = 1)
         return None
 
 
@@ -991,35 +1813,14 @@ class AssemblerParser(BaseParser):
             return self.trymatch('sp','r0','r2')
 
     def registers(self) -> int:
-        r = self.chars('rR')
-        reg = self.chars('0-3')
-        return int(reg)
-
-    def cpp_str(self) -> str:
-        str_value = []
-        ch = self.chars('A-Za-z0-9_.<>//- ///')
-        str_value.append(ch)
-
-        while True:
-            ch = self.peek_chars('A-Za-z0-9_.<>//- ///')
-            if (ch is None):
-                break
-            str_value.append(ch)
-
-        return ''.join(str_value)
+        tok = self.peek_token('register')
+        if (tok is None or tok.text not in self.REGISTERS):
+            raise ParserException(f"Expected register but got <{self.current()}>")
+        self.pos += 1
+        return self.REGISTERS[tok.text]
 
     def symbolstr(self) -> str:
-        symbol = []
-        ch = self.chars('A-Za-z0-9_')
-        symbol.append(ch)
-        while True:
-            ch = self.peek_chars('A-Za-z0-9_',dont_gobble=True)
-            if (ch is None):
-                break
-
-            symbol.append(ch)
-
-        return SymbolWordData(''.join(symbol),self.symbolTable)
+        return SymbolWordData(self.token('symbol','mnemonic','register'),self.symbolTable)
 
 
     def number16bit(self) -> int:
@@ -1035,191 +1836,841 @@ class AssemblerParser(BaseParser):
 
 
     def octalnumber(self) -> int:
-        chars = []
-
-        if (self.trymatch('0o')):
-            chars += '0o'
-            chars.append(self.chars('0-7'))
-
-            while True:
-                char = self.peek_chars('0-7')
-                if char is None:
-                    break
-                chars.append(char)
-            return int(''.join(chars),8)
+        tok = self.peek_token('number')
+        if (tok is not None and tok.text.startswith('0o')):
+            self.pos += 1
+            return int(tok.text,8)
 
 
     def binarynumber(self) -> int:
-        chars = []
-        #v = self.trymatch('0b')
-        if (self.trymatch('0b')):
-            chars += '0b'
-            chars.append(self.chars('0-1'))
-            while True:
-                char = self.peek_chars('0-1')
-                if char is None:
-                    break
-                chars.append(char)
-            return int(''.join(chars),2)
+        tok = self.peek_token('number')
+        if (tok is not None and tok.text.startswith('0b')):
+            self.pos += 1
+            return int(tok.text,2)
 
 
     def hexnumber(self) -> int:
-        chars = []
+        tok = self.peek_token('number')
+        if (tok is not None and tok.text.startswith('0x')):
+            self.pos += 1
+            return int(tok.text,16)
 
-        if (self.trymatch('0x')):
-            chars += '0x'
-            chars.append(self.chars('0-9A-Fa-f'))
 
-            while True:
-                char = self.peek_chars('0-9A-Fa-f')
-                if char is None:
-                    break
-                chars.append(char)
-            return int(''.join(chars),16)
 
+    def decnumber(self) -> int:
+        tok = self.peek_token('number')
+        if (tok is not None and tok.text[:2] not in ('0b','0x','0o')):
+            self.pos += 1
+            return int(tok.text)
 
 
-    def decnumber(self) -> int:
 
-        chars = []
-        sgn = self.peek_chars('+//-')
-        if sgn is not None:
-            chars.append(sgn)
 
-        chars.append(self.chars('0-9'))
+def read_source_lines(stream, chunk_size: int = 1<<16):
+    """Yield lines from a file or pipe - read in large buffered chunks"""
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if len(chunk) == 0:
+            break
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        yield from lines
+    if len(pending) > 0:
+        yield pending
 
-        while True:
-            ch = self.peek_chars('0-9')
-            if ch is None:
-                break
-            chars.append(ch)
 
-        return int(''.join(chars))
+class PreprocessorError(Exception):
+        def __init__(self,msg):
+            self.msg = msg
 
+        def __str__(self):
+            return f"**PreprocessorError**: {self.msg}"
 
 
+class Include(NamedTuple):
+    path : str
+    depth : int
 
-if __name__ == '__main__':
 
-    class SyntaxError(Exception):
-        def __init__(self, msg, pos):
-            self.msg = msg
-            self.pos = pos
+@dataclass
+class Macro:
+    body : str
+    params : [str] = None       # None for an object-like macro
+
+
+class Preprocessor:
+    """
+    Built-in subset of the C preprocessor - so sources no longer need a
+    round trip through 'cpp'.
+
+        #define NAME body                 (object-like)
+        #define NAME(a,b) body            (function-like) lines may be continued with '\\'
+        #undef NAME
+        #include "file"                   (relative to the including file, then include_paths)
+        #ifdef NAME / #ifndef NAME / #else / #endif
+        .equ NAME, value                  (same as '#define NAME value')
+
+    lines() yields (text, source_file, source_line) - so no linemarkers are needed.
+    Any other '#' line (eg. a cpp linemarker) is passed through to the parser.
+    """
+
+    DIRECTIVE_RE = re.compile(r'\s*#\s*(define|undef|include|ifdef|ifndef|else|endif)\b\s*(.*)')
+    DEFINE_RE = re.compile(r'([A-Za-z_]\w*)(?:\(([^)]*)\))?\s*(.*)', re.DOTALL)
+    INCLUDE_RE = re.compile(r'["<]([^">]+)[">]')
+    EQU_RE = re.compile(r'\s*\.equ\s+([A-Za-z_]\w*)\s*,?\s*([^;]*)')
+
+    # Strings and comments are copied as they are. Numbers are skipped so
+    # that the 'x1f' of '0x1f' is never taken for an identifier.
+    EXPAND_RE = re.compile(r"'[^']*'|;.*|\d\w*|(?P<name>[A-Za-z_]\w*)")
+    IDENTIFIER_RE = re.compile(r'[A-Za-z_]\w*')
+
+    MAX_INCLUDE_DEPTH = 32
+
+    def __init__(self, defines: dict = None, include_paths: [str] = None, log = None):
+        self.macros = {name: Macro(str(body)) for name, body in (defines or {}).items()}
+        self.include_paths = include_paths if include_paths is not None else ['.']
+        self.errors = 0
+        self.log = log              # diagnostics - stdout if None
+
+    def define(self, name: str, body: str, params: [str] = None) -> None:
+        self.macros[name] = Macro(body.strip(), params)
+
+    def error(self, msg, source_file: str, source_line: int) -> None:
+        self.errors += 1
+        print(f"Assembler **FAILED** on Line {source_line} '{source_file}' {msg}", file = self.log)
+
+    def lines(self, source_file: str, stream = None, depth: int = 0):
+        """Yield (text, source_file, source_line) for each line the assembler should see"""
+        for item in self.file_lines(source_file, stream, depth):
+            if isinstance(item, Include):
+                yield from self.lines(item.path, depth = item.depth)
+            else:
+                yield item
+
+    def file_lines(self, source_file: str, stream = None, depth: int = 0):
+        """As lines() - but an #include yields an Include for the caller to follow"""
+        if stream is None:
+            with open(source_file, "r") as f:
+                yield from self.file_lines(source_file, f, depth)
+            return
+
+        conditions = []         # one entry per open #ifdef - True if its lines are assembled
+        active = True
+        continued = None        # (text so far, line) while joining '\' continuation lines
+
+        for source_line, text in enumerate(read_source_lines(stream), 1):
+
+            # Splice continuation lines - reported against their first line
+            if continued is not None:
+                text = continued[0] + text
+                source_line = continued[1]
+                continued = None
+            if text.endswith('\\'):
+                continued = (text[:-1], source_line)
+                continue
 
-        def __str__(self):
-            return f'{self.msg} at line {self.pos}'
+            try:
+                directive = self.DIRECTIVE_RE.match(text)
+                if directive is not None:
+                    name, args = directive.group(1), directive.group(2).strip()
+
+                    if name in ('ifdef', 'ifndef'):
+                        conditions.append(active)
+                        active = active and ((args in self.macros) == (name == 'ifdef'))
+                    elif name == 'else':
+                        if len(conditions) == 0:
+                            raise PreprocessorError("#else without #ifdef")
+                        active = conditions[-1] and not active
+                    elif name == 'endif':
+                        if len(conditions) == 0:
+                            raise PreprocessorError("#endif without #ifdef")
+                        active = conditions.pop()
+                    elif not active:
+                        pass
+                    elif name == 'define':
+                        macro = self.DEFINE_RE.match(args)
+                        if macro is None:
+                            raise PreprocessorError(f"Bad #define '{args}'")
+                        params = macro.group(2)
+                        self.define(macro.group(1), macro.group(3),
+                                    None if params is None else [_p.strip() for _p in params.split(',') if _p.strip()])
+                    elif name == 'undef':
+                        self.macros.pop(args, None)
+                    elif name == 'include':
+                        yield Include(self.find_include(args, source_file, depth), depth + 1)
+                    continue
+
+                if not active:
+                    continue
+
+                equ = self.EQU_RE.match(text)
+                if equ is not None:
+                    self.define(equ.group(1), equ.group(2))
+                    continue
+
+                yield (self.expand(text) if self.macros else text), source_file, source_line
+
+            except PreprocessorError as e:
+                self.error(e, source_file, source_line)
+
+        if continued is not None:
+            yield continued[0], source_file, continued[1]
+        if len(conditions) > 0:
+            self.error(PreprocessorError("Unterminated #ifdef/#ifndef"), source_file, source_line)
+
+    def find_include(self, args: str, source_file: str, depth: int) -> str:
+        name = self.INCLUDE_RE.match(args)
+        if name is None:
+            raise PreprocessorError(f"Bad #include {args}")
+        if depth >= self.MAX_INCLUDE_DEPTH:
+            raise PreprocessorError(f"#include nested too deeply {args}")
+
+        path = self.find_file(name.group(1), source_file)
+        if path is None:
+            raise PreprocessorError(f"Can not find #include file {args}")
+        return path
+
+    def find_file(self, name: str, source_file: str) -> str:
+        """'name' relative to the file naming it, then each of the include_paths - None if not found"""
+        for directory in [os.path.dirname(source_file)] + self.include_paths:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                return os.path.normpath(path)
+        return None
 
-    def produceBinFile(binName: str, ops: [AssemblerOperation]) -> int:
-        combinarray = []
+    def expand(self, text: str, disabled: frozenset = frozenset()) -> str:
+        """Replace macro names in text - rescanning each replacement with that macro disabled"""
+        out = []
+        pos = 0
+        while True:
+            m = self.EXPAND_RE.search(text, pos)
+            if m is None:
+                break
+            name = m.group('name')
+            if name is None or name not in self.macros or name in disabled:
+                out.append(text[pos:m.end()])
+                pos = m.end()
+                continue
+
+            macro = self.macros[name]
+            end = m.end()
+            replacement = macro.body
+            if macro.params is not None:
+                args, end = self.macro_args(text, end)
+                if args is None:
+                    # Function-like macro name without an argument list - leave it alone
+                    out.append(text[pos:m.end()])
+                    pos = m.end()
+                    continue
+                if len(args) != len(macro.params):
+                    raise PreprocessorError(f"Macro '{name}' expects {len(macro.params)} arguments but got {len(args)}")
+                values = dict(zip(macro.params, [self.expand(_a, disabled) for _a in args]))
+                replacement = self.IDENTIFIER_RE.sub(lambda p: values.get(p.group(), p.group()), replacement)
+
+            out.append(text[pos:m.start()])
+            out.append(self.expand(replacement, disabled | {name}))
+            pos = end
+
+        out.append(text[pos:])
+        return ''.join(out)
+
+    def macro_args(self, text: str, pos: int) -> ([str], int):
+        """Split '(a, b)' at pos into its arguments - returns (None, pos) when there is no '('"""
+        while pos < len(text) and text[pos] in WSPACE:
+            pos += 1
+        if pos >= len(text) or text[pos] != '(':
+            return None, pos
+
+        args = []
+        depth = 0
+        start = pos + 1
+        for index in range(pos + 1, len(text)):
+            ch = text[index]
+            if ch == '(':
+                depth += 1
+            elif ch == ')':
+                if depth == 0:
+                    args.append(text[start:index].strip())
+                    return ([] if args == [''] else args), index + 1
+                depth -= 1
+            elif ch == ',' and depth == 0:
+                args.append(text[start:index].strip())
+                start = index + 1
+        raise PreprocessorError(f"Unterminated macro arguments '{text[pos:]}'")
 
-        file = open(binName, "wb")
 
-        for op in ops:
-            binarray = builder.build(op)
-            combinarray += binarray
 
-        file.write(bytes(combinarray))
-        file.close()
-        return len(combinarray)
 
+@dataclass
+class CacheEntry:
+    ops : [AssemblerOperation]
+    macros : dict
+    dependencies : [(str, str)]     # (path, content hash) of each file included
+    completed : bool = False        # '.end' was reached
+
+
+class ParseCache:
+    """
+    On-disk cache of parsed source files. An entry holds the operations parsed
+    from a file (and everything it includes) along with the macros defined once
+    it has been read. It is keyed by the file's content hash, the assembler
+    version and the macros defined on entry - and is only used while every file
+    it included still has the same content.
+    """
+
+    DEFAULT_DIRECTORY = '.sap2cache'
+
+    def __init__(self, directory: str = DEFAULT_DIRECTORY):
+        self.directory = directory
+        with open(__file__, 'rb') as f:
+            # Any change to the assembler itself invalidates every entry
+            self.version = hashlib.sha256(f.read()).hexdigest()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def key(self, source_file: str, content_hash: str, macros: dict) -> str:
+        defined = repr(sorted((_n, _m.body, _m.params) for _n, _m in macros.items()))
+        return hashlib.sha256('\0'.join([self.version, source_file, content_hash, defined]).encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.pickle')
+
+    def load(self, key: str) -> CacheEntry:
+        try:
+            entry = self.read(key)
+            for path, content_hash in entry.dependencies:
+                with open(path, 'r') as f:
+                    if self.content_hash(f.read()) != content_hash:
+                        raise ValueError(f"'{path}' has changed")
+        except (OSError, ValueError, EOFError, KeyError, pickle.UnpicklingError, AttributeError) as e:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
 
+    def read(self, key: str) -> CacheEntry:
+        with open(self.path(key), 'rb') as f:
+            return pickle.load(f)
 
-    def produceV2HexFile(binName: str, ops) -> int:
+    def store(self, key: str, entry: CacheEntry) -> None:
+        """Raises OSError if the entry could not be written"""
+        os.makedirs(self.directory, exist_ok = True)
+        tmp = self.path(key) + f'.{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path(key))
 
-        file = open(binName, "w+")
-        file.write("v2.0 raw\n")
-        totalsize = 0
-        bcnt = 0
 
-        for op in ops:
-            if op.size > 0:
-                binarray = builder.build(op)
-                totalsize += len(binarray)
-                for index, bytecode in enumerate(binarray):
-                    file.write(f"{bytecode:02x} ")
-                    if (bcnt % 8 == 7):
-                        file.write("\n")
-                    bcnt += 1
+class MemoryParseCache(ParseCache):
+    """
+    A ParseCache kept in memory rather than on disk - for --watch, where the same
+    process rebuilds again and again. Entries are checked just the same.
+    """
 
-        file.write("\n")
-        file.close()
-        return totalsize
+    def __init__(self):
+        super().__init__(directory = '<memory>')
+        self.entries = {}
+
+    def read(self, key: str) -> CacheEntry:
+        return self.entries[key]
+
+    def store(self, key: str, entry: CacheEntry) -> None:
+        self.entries[key] = entry
+
+
+class SourceParser:
+    """
+    Feeds the lines of a source file through the Preprocessor and the
+    AssemblerParser - building up the list of AssemblerOperations, each tagged
+    with the file and line it came from. Given a ParseCache, a file whose content
+    (and entry macros) are unchanged is loaded rather than parsed again. Given an
+    Assembler, each operation is handed on to it as soon as it is parsed.
+
+    The list of operations is only built up when something needs it after the
+    Assembler has them - the ParseCache (which has no use for comments), a
+    listing, or a SourceParser with no Assembler.
+    """
+
+    def __init__(self, parser: AssemblerParser, preprocessor: Preprocessor, cache: ParseCache = None,
+                 assembler: Assembler = None, debug: bool = False, listing: bool = False, log = None):
+        self.log = log              # diagnostics - stdout if None
+        self.parser = parser
+        self.preprocessor = preprocessor
+        self.cache = cache
+        self.assembler = assembler
+        self.debug = debug
+        self.listing = listing or assembler is None
+        self.completed = False      # '.end' has been seen
+        self.errors = 0             # lines which failed to parse
+        self.dependencies = []      # (path, content hash) of each source file read - the hash is None without a cache
+        self.binaries = {}          # every file read by .incbin (dict as an ordered set)
+        self.cpp_source = None      # first source file named by a cpp linemarker
+        self.cpp_files = {}         # every file named by a cpp linemarker (dict as an ordered set)
+
+    def parse_file(self, source_file: str, stream = None, depth: int = 0) -> [AssemblerOperation]:
+        if stream is not None:
+            # A pipe can not be hashed up front - so is never cached
+            return self.parse_lines(source_file, stream, depth)
+
+        if self.cache is None:
+            # Only the cache needs the content hash - otherwise the file is streamed a line at a time
+            self.dependencies.append((source_file, None))
+            return self.parse_lines(source_file, None, depth)
+
+        with open(source_file, 'r') as f:
+            content = f.read()
+        content_hash = ParseCache.content_hash(content)
+        first_dependency = len(self.dependencies) + 1
+        self.dependencies.append((source_file, content_hash))
+
+        key = self.cache.key(source_file, content_hash, self.preprocessor.macros)
+        entry = self.cache.load(key)
+        if entry is not None:
+            self.preprocessor.macros = dict(entry.macros)
+            self.completed = entry.completed
+            self.dependencies += entry.dependencies
+            self.rebind(entry.ops)
+            for op in entry.ops:
+                self.emit(op)
+            return entry.ops
+
+        errors = self.errors + self.preprocessor.errors
+        ops = self.parse_lines(source_file, io.StringIO(content), depth)
+
+        if self.errors + self.preprocessor.errors == errors:
+            try:
+                self.cache.store(key, CacheEntry(ops, dict(self.preprocessor.macros),
+                                                 self.dependencies[first_dependency:], self.completed))
+            except OSError as e:
+                print(f"**WARNING** Could not write parse cache {e}", file = self.log)
+        return ops
+
+    def parse_lines(self, source_file: str, stream, depth: int = 0) -> [AssemblerOperation]:
+        code = []
+        keep = self.listing or self.cache is not None
+        linemarker = None   # (file, line, source_line) of the last cpp linemarker - if piped from cpp
+
+        for item in self.preprocessor.file_lines(source_file, stream, depth):
+            if self.completed:
+                break
 
+            if isinstance(item, Include):
+                code += self.parse_file(item.path, depth = item.depth)
+                continue
 
-    def produceV3HexFile(binName: str, ops, addrOffset: int  = 0x8000) -> int:
+            text, current_filename, source_line = item
+            line = source_line
+            if (linemarker is not None):
+                current_filename, line = linemarker[0], linemarker[1] + source_line - linemarker[2]
+            try:
+                # Parse a line and build up code operations (a single line could have multiple operations)
+                operations = self.parser.parse(text.strip())
+                for op in operations:
 
-        file = open(binName, "w+")
-        file.write("v3.0 hex words addressed\n")
+                     if (op is not None):
+                        # Check for any CPP directives which would tell is the source file.
+                        # and line number
+                        if (op.operation == 'cppline'):
+                            line = op.source_line
+                            current_filename = op.source_file
+                            linemarker = (current_filename, line, source_line)
+                            if (self.cpp_source is None):
+                                self.cpp_source = current_filename
 
-        address = 0
-        lastaddr = -1
-        totalsize = 0
-        bytecount = 0
-        lastaddrfromORG = -1
-        bytecountfromORG = 0
+                        op.source_line = line          # Fill operator with line number
+                        op.source_file = current_filename
 
-        for opindex,op in enumerate(ops):
-            binarray = builder.build(op)
-            sz = len(binarray)
-            totalsize += sz
+                        if (self.debug):
+                            print(op, file = self.log)
+                        if (keep and (self.listing or op.operation != 'comment')):
+                            code.append(op)     # Place this in an ordered array for the cache or listing
+                        self.emit(op)
 
-            address = op.pc
+                        if (op.operation == 'end'):
+                            self.completed = True
 
-            if (address != lastaddrfromORG) and \
-                (op.operation == 'org' or (lastaddrfromORG == -1 and sz > 0)):
+            except Exception as e:
+                self.errors += 1
+                print(f"Assembler **FAILED** on Line {line} '{current_filename}' {e}", file = self.log)
 
-                bytecountfromORG = 0
-                lastaddrfromORG = address
-                if (addrOffset > address):
-                    print("***WARNING*** address mismatch on assembling. Please check ORG directives - if assembling for RAM. Ignoring base address offset..")
-                file.write(f"\n{ address - (addrOffset if addrOffset <= address else 0):04x}: ")
+        return code
 
-            if (sz > 0):
-                for index,byteopcode in enumerate(binarray):
-                    if (bytecountfromORG % 32 == 31):
-                        file.write(f"\n{(address  + index - addrOffset if addrOffset <= address else 0):04x}: ")
-                    file.write(f"{byteopcode:02x} ")
-                    bytecountfromORG += 1
+    def source_files(self) -> [str]:
+        """Every file which fed the build - read directly or named by a cpp linemarker"""
+        return list(dict.fromkeys([path for path, content_hash in self.dependencies] +
+                                  [path for path in self.cpp_files if os.path.isfile(path)] + list(self.binaries)))
 
+    def emit(self, op: AssemblerOperation) -> None:
+        if (op.operation == 'cppline'):
+            self.cpp_files[op.source_file] = None
+        if self.assembler is None:
+            return
+        try:
+            if (op.operation == 'incbin'):
+                self.include_binary(op)
+            self.assembler.emit(op)
+        except (SymbolError, ImageError, PreprocessorError, OSError) as e:
+            self.errors += 1
+            print(f"Assembler **FAILED** on Line {op.source_line} '{op.source_file}' {e}", file = self.log)
+
+    def include_binary(self, op: AssemblerOperation) -> None:
+        """
+        Read an .incbin file - every time, even for an operation from the parse cache,
+        so a changed file is always picked up. A fresh FileData as the parser's line
+        cache may share one between operations.
+        """
+        name = op.data.getRawData()
+        path = self.preprocessor.find_file(name, op.source_file or '')
+        if path is None:
+            raise PreprocessorError(f"Can not find .incbin file '{name}'")
+        with open(path, 'rb') as f:
+            content = f.read()
+        self.binaries[path] = None
+        op.data = FileData(name, content)
+        op.size = len(content)
+
+    def rebind(self, ops: [AssemblerOperation]) -> None:
+        """Point symbol references loaded from the cache at our symbol table"""
+        for op in ops:
+            data = op.data.data if isinstance(op.data, FunctionData) else op.data
+            if isinstance(data, SymbolWordData):
+                data.lut = self.parser.symbolTable
+            if (self.debug):
+                print(op, file = self.log)
+
+
+class Profile:
+    """
+    --profile - where assembly time goes. Each phase is timed by wrapping the
+    methods of the object doing the work, so nothing is paid when not profiling.
+    Time spent in a nested phase (building an instruction while it is being placed)
+    is not counted in its caller. The parser's rules are counted the same way -
+    calls and failures of each rule, chars() and peek_chars() pattern.
+
+    With 'memory' (and tracemalloc tracing) the peak traced memory while in each
+    phase is kept too - unlike the times this does include nested phases.
+    """
+
+    def __init__(self, memory: bool = False):
+        self.start = time.perf_counter()
+        self.memory = memory
+        self.peak = 0           # highest traced memory seen
+        self.phases = {}        # name -> [calls, seconds, peak memory]
+        self.stack = []         # [name, start, seconds in nested phases, peak memory] of each phase we are in
+        self.rules = {}         # rule name -> [calls, failures]
+        self.chars = {}         # chars() pattern -> [calls, failures]
+        self.peek_chars = {}    # peek_chars() pattern -> [calls, failures]
+        self.pattern_cache = [0, 0]     # BaseParser._cache [hits, lookups]
+        self.parser = None
+
+    def traced_peak(self) -> int:
+        """Peak traced memory since the last call - the caller's phase gets it"""
+        peak = tracemalloc.get_traced_memory()[1]
+        if (hasattr(tracemalloc, 'reset_peak')):
+            tracemalloc.reset_peak()
+        else:
+            # Before Python 3.9 - a restart also forgets what is already traced, so peaks are from here on
+            tracemalloc.stop()
+            tracemalloc.start()
+        self.peak = max(self.peak, peak)
+        return peak
+
+    def enter(self, name: str) -> None:
+        if (self.memory and self.stack):
+            self.stack[-1][3] = max(self.stack[-1][3], self.traced_peak())
+        elif (self.memory):
+            self.traced_peak()
+        self.stack.append([name, time.perf_counter(), 0.0, 0])
+
+    def leave(self) -> None:
+        name, start, nested, peak = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        phase = self.phases.setdefault(name, [0, 0.0, 0])
+        phase[0] += 1
+        phase[1] += elapsed - nested
+        if (self.memory):
+            peak = max(peak, self.traced_peak())
+            phase[2] = max(phase[2], peak)
+        if (self.stack):
+            self.stack[-1][2] += elapsed
+            self.stack[-1][3] = max(self.stack[-1][3], peak)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.leave()
+
+    def wrap(self, obj, method: str, name: str) -> None:
+        func = getattr(obj, method)
+        def timed(*args, **kwargs):
+            self.enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.leave()
+        setattr(obj, method, timed)
+
+    def count(self, obj, method: str, counts: dict, failed) -> None:
+        """Count calls of 'method' by its first argument - and those 'failed' says failed"""
+        func = getattr(obj, method)
+        def counted(key, *args, **kwargs):
+            tally = counts.get(key)
+            if (tally is None):
+                tally = counts[key] = [0, 0]
+            tally[0] += 1
+            try:
+                rv = func(key, *args, **kwargs)
+            except ParserException:
+                tally[1] += 1
+                raise
+            if (failed(rv)):
+                tally[1] += 1
+            return rv
+        setattr(obj, method, counted)
+
+    def instrument(self, parser: 'AssemblerParser', assembler: 'Assembler', source: 'SourceParser') -> None:
+        self.parser = parser
+        self.wrap(source, 'parse_file', 'read/preprocess')
+        self.wrap(parser, 'parse', 'parse')
+        self.wrap(assembler, 'emit', 'address')
+        self.wrap(assembler.builder, 'build', 'build')
+        self.wrap(assembler, 'finish', 'fixups')
+
+        self.count(parser, 'apply_rule', self.rules, lambda rv: rv is None)
+        self.count(parser, 'peek_chars', self.peek_chars, lambda rv: rv is None)
+        match_chars = parser.match_chars
+        def cached_chars(pattern, *args, **kwargs):
+            self.pattern_cache[0] += pattern in parser._cache
+            self.pattern_cache[1] += 1
+            return match_chars(pattern, *args, **kwargs)
+        parser.match_chars = cached_chars
+        self.count(parser, 'chars', self.chars, lambda rv: False)
+
+    def results(self) -> dict:
+        total = time.perf_counter() - self.start
+        phases = {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds, peak) in self.phases.items()}
+        phases['other'] = {'calls': 1, 'seconds': total - sum(seconds for calls, seconds, peak in self.phases.values())}
+        if (self.memory):
+            for name, (calls, seconds, peak) in self.phases.items():
+                phases[name]['peak'] = peak
+        tallies = lambda counts: {key: {'calls': calls, 'failures': failures}
+                                    for key, (calls, failures) in sorted(counts.items(), key = lambda item: -item[1][0])}
+        results = {'total': total, 'phases': phases, 'rules': tallies(self.rules), 'chars': tallies(self.chars),
+                   'peek_chars': tallies(self.peek_chars),
+                   'pattern_cache': {'hits': self.pattern_cache[0], 'lookups': self.pattern_cache[1]}}
+        if (self.memory):
+            results['peak'] = max(self.peak, tracemalloc.get_traced_memory()[1])
+        if (self.parser is not None):
+            hits, lookups = self.parser.line_cache_stats()
+            results['line_cache'] = {'hits': hits, 'lookups': lookups}
+            hits, lookups = self.parser.memo_stats()
+            results['memo'] = {'hits': hits, 'lookups': lookups}
+        return results
+
+    def report(self) -> [str]:
+        results = self.results()
+        ratio = lambda hits, lookups: f"{hits}/{lookups} ({100.0*hits/max(lookups,1):.1f}%)"
+        lines = [f"Profile - {1000*results['total']:.1f} ms wall time (nested phases are not counted in their caller)"]
+        lines += [f"  {name:16} {1000*phase['seconds']:9.2f} ms {100*phase['seconds']/max(results['total'],1e-9):5.1f}% {phase['calls']:8} calls"
+                  + (f"  peak {phase['peak'] / (1<<20):7.1f} MB" if 'peak' in phase else '')
+                    for name, phase in results['phases'].items()]
+        if ('peak' in results):
+            lines.append(f"Peak traced memory {results['peak'] / (1<<20):.1f} MB")
+        for title, key in (('Parser rules', 'rules'), ('chars() patterns', 'chars'), ('peek_chars() patterns', 'peek_chars')):
+            lines.append(f"{title} - calls, failures:")
+            lines += [f"  {name!s:24} {tally['calls']:8} {tally['failures']:8}" for name, tally in results[key].items()]
+        lines.append(f"Pattern cache (_cache) hits: {ratio(**results['pattern_cache'])}")
+        if ('line_cache' in results):
+            lines.append(f"Line cache hits: {ratio(**results['line_cache'])}")
+            lines.append(f"Packrat memo hits: {ratio(**results['memo'])}")
+        return lines
+
+
+def assemble(source, origin: int = 0, rom: bool = False, defines: dict = None, filename: str = '<source>',
+             parser: AssemblerParser = None, listing: bool = False, profile: Profile = None) -> ProgramImage:
+    """
+    Assemble 'source' - the text of a program (or a stream of its lines) - in process.
+    Nothing is shared between calls. Code ahead of any '.org' starts at 'origin';
+    'rom' makes the image's V3 hex addresses relative to ROM_ADDRESS rather than
+    RAM_ADDRESS. The image carries the symbol table, the error count and every
+    diagnostic - each call logs to its own stream, so nothing goes to stdout and
+    calls can run in several threads at once.
+
+    Passing an AssemblerParser keeps its line cache warm from call to call - its
+    symbol table is cleared and reused (so one call at a time per parser). With
+    'listing' the image keeps every operation - labels and comments included.
+    A Profile passed in is instrumented with this call's parser and assembler.
+    """
+    log = io.StringIO()
+    if parser is None:
+        parser = AssemblerParser({})
+    parser.log = log
+    labels = parser.symbolTable
+    labels.clear()
+    preprocessor = Preprocessor(dict(defines or {}), log = log)
+    asm = Assembler(labels, origin, listing, log)
+    source_parser = SourceParser(parser, preprocessor, None, asm, listing = listing, log = log)
+    if (profile is not None):
+        profile.instrument(parser, asm, source_parser)
+    failed = 0
+    try:
+        source_parser.parse_file(filename, io.StringIO(source) if isinstance(source, str) else source)
+        asm.finish()
+    except Exception as e:
+        print(f"Assembler **FAILED** '{filename}' {e}", file = log)
+        failed = 1
+
+    image = asm.image
+    image.offset = ROM_ADDRESS if rom else RAM_ADDRESS
+    image.labels = dict(labels)
+    image.errors = source_parser.errors + preprocessor.errors + asm.builder.errors + failed
+    image.log = log.getvalue()
+    return image
+
+
+class BatchResult(NamedTuple):
+    source: str
+    size: int           # bytes assembled
+    errors: int         # lines which failed to parse, preprocessor and symbol table errors
+    elapsed: float      # seconds
+    digest: str         # sha256 of the assembled bytes - in .bin order
+    log: str            # everything the assembly printed
+    sources: list = []  # every file which fed the build
+
+
+def assemble_file(source_file: str, outTypes: [OutputType] = (), addrOffset: int = RAM_ADDRESS, defines: dict = None,
+                  cache: ParseCache = None, depfile: bool = False) -> BatchResult:
+    """
+    Assemble one source file with its own symbol table - writing the 'outTypes'
+    output files (and, if 'depfile', a make dependency file for them)
+    """
+    start = time.perf_counter()
+    log = io.StringIO()
+    labels = {}
+    parser = AssemblerParser(labels)
+    parser.log = log
+    preprocessor = Preprocessor(dict(defines or {}), log = log)
+    asm = Assembler(labels, log = log)
+    source = SourceParser(parser, preprocessor, cache, asm, log = log)
+    try:
+        source.parse_file(source_file)
+        asm.finish()
+        errors = source.errors + preprocessor.errors + asm.builder.errors
+        if (preprocessor.errors == 0):
+            basename = output_basename(source_file)
+            targets = []
+            for imageName, image, offset in outputImages(asm.image, basename, addrOffset, bool(asm.sections)):
+                binNames = outputFilenames(imageName, outTypes)
+                for outType in outTypes:
+                    produceOutputFile(outType, binNames[outType], image, offset, log)
+                    targets.append(binNames[outType])
+            if (depfile and targets):
+                produceDepFile(basename + ".d", targets, source.source_files())
+    except Exception as e:
+        print(f"Assembler **FAILED** '{source_file}' {e}", file = log)
+        errors = source.errors + preprocessor.errors + asm.builder.errors + 1
+
+    combinarray = asm.image.tobytes()
+    return BatchResult(source_file, len(combinarray), errors, time.perf_counter() - start,
+                       hashlib.sha256(combinarray).hexdigest(), log.getvalue(), source.source_files())
+
+
+def assemble_batch(source_files: [str], outTypes: [OutputType] = (), addrOffset: int = RAM_ADDRESS,
+                   defines: dict = None, workers: int = None, depfile: bool = False) -> [BatchResult]:
+    """Assemble each source file - spread over a pool of worker processes. Results are in 'source_files' order"""
+    source_files = list(source_files)
+    workers = min(workers or os.cpu_count() or 1, max(len(source_files), 1))
+    chunksize = max(1, len(source_files) // (workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(functools.partial(assemble_file, outTypes = outTypes, addrOffset = addrOffset, defines = defines, depfile = depfile),
+                             source_files, chunksize = chunksize))
+
+
+class AssemblyServer(socketserver.UnixStreamServer):
+    """
+    Answers assemble requests on a local Unix socket - one JSON object per line in,
+    one JSON object per line back. A single AssemblerParser (with its line cache) and
+    Dissassembler stay warm for the life of the server; requests are handled one
+    at a time.
+
+    Request:  {"source": "<program text>" | "path": "file.asm",
+               "origin": 0, "rom": false, "defines": {"NAME": "value"}, "listing": false}
+    Response: {"errors": 0, "diagnostics": [...], "size": 10, "labels": {...},
+               "segments": [[address, "hex bytes"], ...], "listing": [...], "elapsed_ms": 0.3}
+              or {"error": "..."} if the request itself is bad.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path, AssemblyRequestHandler)
+        self.parser = AssemblerParser({})
+        self.dissassembler = Dissassembler()
+
+    def assemble_request(self, request: dict) -> dict:
+        start = time.perf_counter()
+        if 'source' in request:
+            source, filename = request['source'], request.get('filename', '<source>')
+        elif 'path' in request:
+            with open(request['path'], 'r') as f:
+                source, filename = f.read(), request['path']
+        else:
+            raise ValueError("request needs a 'source' or a 'path'")
 
-        file.write("\n")
-        file.close()
-        return totalsize
+        image = assemble(source, int(request.get('origin', 0)), bool(request.get('rom', False)),
+                         request.get('defines'), filename, self.parser)
 
+        response = {'errors': image.errors,
+                    'diagnostics': image.log.splitlines(),
+                    'size': image.size(),
+                    'labels': image.labels,
+                    'segments': [[address, data.hex()] for address, data in image.segments()]}
+        if request.get('listing', False):
+            response['listing'] = produceListing(image, self.dissassembler)
+        response['elapsed_ms'] = 1000 * (time.perf_counter() - start)
+        return response
 
-    def produceDummyOuput(ops) -> int:
-        totalsize = 0
-        for opindex,op in enumerate(ops):
-            binarray = builder.build(op)
-            sz = len(binarray)
-            totalsize += sz
-        return totalsize
 
+class AssemblyRequestHandler(socketserver.StreamRequestHandler):
 
-    def produceCodeOuput(ops) -> int:
-        totalsize = 0
+    def handle(self) -> None:
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be a JSON object")
+                response = self.server.assemble_request(request)
+            except (ValueError, TypeError, OSError) as e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
 
-        dissassembler = Dissassembler()
 
-        for opindex,op in enumerate(ops):
-            binarray = builder.build(op)
-            sz = len(binarray)
-            if (sz > 0):
-                print(f'{op.pc:04X}\t',end='')
-                bc = ''.join([f'{_x:02X}' for _i,_x in enumerate(binarray) if _i < 128])
-                print(f'{bc}',end='')
-                print(f'\t{dissassembler.dissassemble(op)}')
-            totalsize += sz
-        return totalsize
+if __name__ == '__main__':
+
+    class SyntaxError(Exception):
+        def __init__(self, msg, pos):
+            self.msg = msg
+            self.pos = pos
 
-    def processLabel(ops: AssemblerOperation, labels: dict) -> None:
+        def __str__(self):
+            return f'{self.msg} at line {self.pos}'
+
+    def produceDummyOuput(image: ProgramImage) -> int:
+        return image.size()
 
-        labelnm = ops.data.getRawData()
-        addr = ops.pc
-        if (labelnm in labels):
-            raise SyntaxError(f"Replicated label '{labelnm}'",ops.line)
-        labels[labelnm] = addr
 
+    def produceCodeOuput(image: ProgramImage) -> int:
+        for line in produceListing(image, tstates = True):
+            print(line)
+        return image.size()
 
     def info(str,end=None) -> None:
         print(str,end='')
@@ -1228,15 +2679,33 @@ if __name__ == '__main__':
         if (check):
             print(str,*args,**kwargs)
 
+    def produceProfile(profile: Profile, profiler: cProfile.Profile, profile_option: [str], profile_out: str = None) -> None:
+        """
+        --profile report - as text or JSON - and any cProfile dump. The report goes to stderr
+        (so it never mixes with the assembler's own output) or to the --profile-out file.
+        """
+        if (profiler is not None):
+            profiler.disable()
+            for name in profile_option:
+                if (name.endswith('.prof')):
+                    profiler.dump_stats(name)
+        report = json.dumps(profile.results(), indent = 1) if 'json' in profile_option else '\n'.join(profile.report())
+        if (profile_out is not None):
+            with open(profile_out, 'w') as f:
+                f.write(report + '\n')
+        else:
+            print(report, file = sys.stderr)
+
     def buildHelpText() -> str:
-        return "\n\nExample: ./assembler.py example.asm [options]\n\n -v verbose\n -d debug\n -q quiet\n -s symbol table\n -3 [default] V3 addressed hex output\n -2 raw hex output\n -b binary output\n -n no output [-c dissassembled code]\n -r ROM address offset on V3 Hex output\n"
+        return "\n\nExample: ./assembler.py example.asm [options]\n\n -v verbose\n -d debug\n -q quiet\n -s symbol table\n -t segment table - code and reserved (.ds) space\n -3 [default] V3 addressed hex output\n -2 raw hex output (to .v2.hex if given with -3)\n -b binary output\n -n no output [-c dissassembled code - with T states and a summary of each basic block]\n -r ROM address offset on V3 Hex output\n -m memoize parser rules (packrat) and report cache hit rate\n -DNAME[=value] define a preprocessor macro\n -i incremental - cache parsed source files in .sap2cache\n -o object file output - link with sap2link.py\n -MD also write a make dependency file (.d) listing every source the output was built from\n --batch file1.asm file2.asm ... assemble each file in a pool of processes - report sizes, errors and times\n --serve /tmp/sap2.sock answer JSON assemble requests on a Unix socket (see AssemblyServer)\n --watch rebuild the outputs whenever the source (or anything it includes) changes\n --profile[=json][,memory][,file.prof] time each phase and count parser rule calls - as text or JSON, optionally with each phase's peak memory and a cProfile dump - reported on stderr\n --profile-out=report.json write the --profile report to a file instead\n\n Use '-' as the source file to assemble from stdin, eg. cpp example.asm | ./assembler.py - -3\n"
 
 
-    def handleCommandArgs(argv: [str]) -> ([str],str,str):
+    def handleCommandArgs(argv: [str]) -> ([str],str,str,[str]):
         """Command line options have NO parameters so just record them"""
 
         options=set()
         file = None
+        files = []
 
         for index,arg in enumerate(argv):
             if (arg.startswith('-') and len(arg) > 1):
@@ -1244,10 +2713,11 @@ if __name__ == '__main__':
             else:
                 if (index > 0):
                     file = arg
+                    files.append(arg)
                 else:
                     assembler = arg
 
-        return options,file,assembler
+        return options,file,assembler,files
 
 
 
@@ -1258,7 +2728,7 @@ if __name__ == '__main__':
     #    sys.exit(-1)
 
     # Command Line options and check if source exists
-    options,sourceFilename,assembler = handleCommandArgs(sys.argv)
+    options,sourceFilename,assembler,sourceFilenames = handleCommandArgs(sys.argv)
 
     try:
 
@@ -1266,7 +2736,7 @@ if __name__ == '__main__':
             hText = buildHelpText()
             raise Exception(f"Source file is needed to assemble!\n{hText}")
 
-        if (not os.path.isfile(sourceFilename)):
+        if (sourceFilename != STDIN_SOURCE and '-serve' not in options and not os.path.isfile(sourceFilename)):
             raise IOError(f"Sourcefile '{sourceFilename}' does not exist.")
 
     except IOError as e:
@@ -1279,21 +2749,91 @@ if __name__ == '__main__':
     debug_option = 'd' in options
     quiet_option = 'q' in options
     symtable_option = 's' in options
+    segtable_option = 't' in options
     help_option = 'h' in options
     nooutput_option = 'n' in options
     dissassembled_code_option ='c' in options
 
     rom_option = 'r' in options
+    memoize_option = 'm' in options
+    incremental_option = 'i' in options
+    object_option = 'o' in options
+    depfile_option = 'MD' in options
+    # --profile, --profile=json, --profile=json,memory,assembler.prof - and --profile-out=report.json
+    profile_option = next((opt.partition('=')[2].split(',') for opt in options if opt == '-profile' or opt.startswith('-profile=')), None)
+    profile_out = next((opt.partition('=')[2] for opt in options if opt.startswith('-profile-out=')), None)
+    if (profile_out is not None and profile_option is None):
+        profile_option = []
     ram_address = RAM_ADDRESS  #Perhaps offer this as an option?
 
-    outType  = OutputType.BINARY if 'b' in options\
-                else OutputType.RAWHEX if '2' in options\
-                else OutputType.ADDRESSEDHEX
+    # Any combination of -b -2 -3 - all serialized from the one ProgramImage
+    outTypes = [outType for outType,opt in ((OutputType.BINARY,'b'), (OutputType.RAWHEX,'2'), (OutputType.ADDRESSEDHEX,'3')) if opt in options]\
+                or [OutputType.ADDRESSEDHEX]
 
     if (help_option):
         print(buildHelpText())
         sys.exit(0);
 
+    # -DNAME or -DNAME=value predefine a macro - as with cpp
+    defines = {opt[1:].partition('=')[0]: opt.partition('=')[2] or '1' for opt in options if opt.startswith('D') and len(opt) > 1}
+
+    if ('-serve' in options):
+        # --serve /tmp/sap2.sock - answer JSON assemble requests until interrupted
+        if (os.path.exists(sourceFilename) and stat.S_ISSOCK(os.stat(sourceFilename).st_mode)):
+            os.unlink(sourceFilename)           # left behind by a server that did not shut down
+        with AssemblyServer(sourceFilename) as server:
+            print_if_true(not quiet_option, f"Serving assemble requests on '{sourceFilename}' - Ctrl-C to stop")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(sourceFilename)
+        sys.exit(0)
+
+    if ('-watch' in options):
+        # --watch - build, then rebuild whenever a file which fed the build changes.
+        # Unchanged files come from the parse cache - in memory unless -i is given
+        if (sourceFilename == STDIN_SOURCE):
+            print("--watch needs a source file - not stdin")
+            sys.exit(-1)
+        cache = ParseCache() if incremental_option else MemoryParseCache()
+
+        def modified(paths: [str]) -> dict:
+            times = {}
+            for path in paths:
+                try:
+                    times[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    times[path] = None
+            return times
+
+        try:
+            while True:
+                result = assemble_file(sourceFilename, [] if nooutput_option else outTypes,
+                                       ROM_ADDRESS if rom_option else ram_address, defines, cache, depfile_option)
+                print_if_true(not quiet_option, result.log, end='')
+                print(f"{time.strftime('%H:%M:%S')} '{sourceFilename}' {result.size} bytes, {result.errors} errors - built in {1000*result.elapsed:.1f} ms from {len(result.sources)} files")
+
+                watched = modified(result.sources or [sourceFilename])
+                while modified(watched) == watched:
+                    time.sleep(0.05)
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    if ('-batch' in options):
+        # --batch file1.asm file2.asm ... - each assembled independently over a pool of processes
+        start = time.perf_counter()
+        results = assemble_batch(sourceFilenames, [] if nooutput_option else outTypes,
+                                 ROM_ADDRESS if rom_option else ram_address, defines, depfile = depfile_option)
+        for result in results:
+            if (result.errors > 0):
+                print_if_true(not quiet_option, result.log, end='')
+            print(f"{result.source:40} {result.size:6} bytes {result.errors:4} errors {1000*result.elapsed:8.1f} ms  {result.digest[:16]}")
+        failed = sum(1 for result in results if result.errors > 0)
+        print(f"\n{len(results)} files assembled, {failed} with errors, in {time.perf_counter() - start:.3f}s")
+        sys.exit(-1 if failed > 0 else 0)
+
     print_if_true(not quiet_option,f"Trying to assemble '{sourceFilename}' \
 ROMMODE:{rom_option}' \
 verbose:{verbose_option} \
@@ -1303,93 +2843,74 @@ symtable:{symtable_option}\n")
 
 
     labels = {}
-    parser = AssemblerParser(labels)        #Assembler Operations need a reference to the
+    parser = AssemblerParser(labels, packrat = memoize_option)
+                                            #Assembler Operations need a reference to the
                                             #actual Symbol table ('labels') for the code generation - part -
                                             #to resolve symbol names (addresses).
 
-                                            # There are no preprocessor symbols/constants (eg.'#DEFINE NUMBEROFLOOPS 0x22')
-                                            # handled by the parser as this can easily be
-                                            # implemented using a decent preprocessor
-                                            # such as 'cpp' or 'm4'
+                                            # Preprocessor symbols/constants (eg.'#define NUMBEROFLOOPS 0x22')
+                                            # are handled before the parser sees a line - see 'Preprocessor'.
+                                            # Sources already run through 'cpp' still work - linemarkers
+                                            # are picked up as 'cppline' operations.
 
                                             # The only thing we may need is something to handle
                                             # finding bytes of an address -
                                             #  such as movi r0,@LOW(16bitaddress/symbol)
 
 
-    asm = open(sourceFilename, "r")
-
-    completed = False
-    assembler_errors = 0
-    code = []
-    line = 0
-    current_filename = sourceFilename
-
-    while not completed:
-        try:
-            text = asm.readline()
-            if len(text) == 0:
-                completed = True
-                break
-
-            line = line + 1
-            try:
-                # Parse a line and build up code operations (a single line could have multiple operations)
-                operations = parser.parse(text.strip())
-                for op in operations:
+    preprocessor = Preprocessor(defines)
+    cache = ParseCache() if incremental_option else None
+    listing = verbose_option or dissassembled_code_option
+    asm = Assembler(labels, listing = listing)      # addresses, labels and bytes - as we parse
+    source = SourceParser(parser, preprocessor, cache, asm, debug = debug_option, listing = listing)
 
-                     if (op is not None):
-                        # Check for any CPP directives which would tell is the source file.
-                        # and line number
-                        if (op.operation == 'cppline'):
-                            line = op.source_line
-                            current_filename = op.source_file
+    profile = profiler = None
+    if (profile_option is not None):
+        if ('memory' in profile_option):
+            tracemalloc.start()
+        profile = Profile(memory = 'memory' in profile_option)
+        profile.instrument(parser, asm, source)
+        if (any(name.endswith('.prof') for name in profile_option)):
+            profiler = cProfile.Profile()
+            profiler.enable()
 
-                        op.source_line = line          # Fill operator with line number
-                        op.source_file = current_filename
+    assembler_errors = 0
 
-                        #if (debug_option):
-                        print_if_true(debug_option, op)
-                        code.append(op)         # Place this in an ordered array for our builder
+    if (sourceFilename == STDIN_SOURCE):
+        code = source.parse_file('<stdin>', sys.stdin)
+        # Piped from cpp - name our output after its first source file
+        outputBasename = None if source.cpp_source is None else output_basename(source.cpp_source)
+    else:
+        code = source.parse_file(sourceFilename)
+        outputBasename = output_basename(sourceFilename)
 
-                        if (op.operation == 'end'):
-                            completed = True
+    assembler_errors += preprocessor.errors
 
-            except Exception as e:
-                print(f"Assembler **FAILED** on Line {line} '{current_filename}' {e}")
+    # Parsing complete
+    if (cache is not None):
+        print_if_true(not quiet_option, f"Parse cache: {cache.hits} of {cache.hits + cache.misses} source files loaded from '{cache.directory}'")
 
-        except KeyboardInterrupt:
-            pass
-        except (EOFError, SystemExit):
-            break
-        except IndexError as e:
-            print(f'Index Error: {e} Line {line}')
-            #break
-        except (ParseError, ZeroDivisionError) as e:
-            print(f'Parse Error: {e} Line {line} {text}')
-            assembler_errors += 1
+    if (memoize_option):
+        hits, lookups = parser.memo_stats()
+        print_if_true(not quiet_option, f"Parser memo: {hits}/{lookups} rule lookups hit ({100.0*hits/max(lookups,1):.1f}%)")
+        hits, lookups = parser.line_cache_stats()
+        print_if_true(not quiet_option, f"Parser line cache: {hits}/{lookups} lines hit ({100.0*hits/max(lookups,1):.1f}%)")
 
-    # Parsing complete
     if (assembler_errors > 0):
         print_if_true(not quiet_option, f"Build Failed! {assembler_errors} assembler errors. See a Code Doctor. Quick!")
+        if (profile is not None):
+            produceProfile(profile, profiler, profile_option, profile_out)
         sys.exit(-1)
 
     try:
 
-        program_counter = 0
-        # Pre-process build a symbol address table
-        for op in code:
+        # Symbol table is now complete - patch up forward references
+        # (for an object file undefined labels are left for sap2link.py)
+        asm.finish(imports = object_option)
 
-            if (op.operation == 'org'):
-                program_counter = op.data.getRawData() # SMELLY
-
-            op.pc = program_counter
-            program_counter += op.size
-
-            if (op.operation == 'symbol'):
-                processLabel(op,labels)
-
-            print_if_true(verbose_option, op)
+        if (verbose_option):
+            for op in code:
+                print(op)
 
 
 
@@ -1398,9 +2919,12 @@ symtable:{symtable_option}\n")
             for lbl in labels:
                 info(f"\t'{lbl}': 0x{labels[lbl]:04x}\n")
 
-        # Now build up binary version of our code
-        builder = Builder(labels)
-        binName = sourceFilename.split(".")[0] + (".bin" if outType == OutputType.BINARY else ".hex")
+        if (not quiet_option and segtable_option):
+            info("Segment Table:\n")
+            for segment in asm.image.segment_table():
+                info(f"\t0x{segment.address:04x}-0x{segment.address + segment.length - 1:04x} {segment.length:5} bytes{' reserved' if segment.reserved else ''}\n")
+
+        basename = outputBasename or STDIN_BASENAME
 
 
         #size = produceHexFile(binName,code)
@@ -1415,24 +2939,40 @@ symtable:{symtable_option}\n")
         #            print("ADDRESSEDHEX")
         #            break
         #info(f"{outType}")
-        if (not nooutput_option):
-
-            print_if_true(not quiet_option, f"Producing LogiSym output file '{binName}'")
-
-            if (outType == OutputType.BINARY):
-                size = produceBinFile(binName, code)
-            elif (outType == OutputType.RAWHEX):
-                size = produceV2HexFile(binName, code)
-            elif (outType == OutputType.ADDRESSEDHEX):
-                size = produceV3HexFile(binName, code, ROM_ADDRESS if rom_option else ram_address)
+        targets = []
+        writing = profile.phase('write') if profile is not None else contextlib.nullcontext()
+        with writing:
+            if (object_option):
+                objName = basename + ".o"
+                print_if_true(not quiet_option, f"Producing object file '{objName}' - imports: {', '.join(asm.imports) or 'none'}")
+                module = asm.object_module(os.path.basename(basename))
+                module.save(objName)
+                size = asm.image.size()
+                targets.append(objName)
+            elif (not nooutput_option):
+
+                size = 0
+                for imageName, image, offset in outputImages(asm.image, basename, ROM_ADDRESS if rom_option else ram_address, bool(asm.sections)):
+                    binNames = outputFilenames(imageName, outTypes)
+                    for outType in outTypes:
+                        binName = binNames[outType]
+                        print_if_true(not quiet_option, f"Producing LogiSym output file '{binName}'")
+                        imageSize = produceOutputFile(outType, binName, image, offset)
+                        targets.append(binName)
+                    size += imageSize
             else:
-                raise Exception('Output type is not defined')
-        else:
-            size = produceCodeOuput(code) if dissassembled_code_option else produceDummyOuput(code)
+                size = produceCodeOuput(asm.image) if dissassembled_code_option else produceDummyOuput(asm.image)
+
+        if (depfile_option and targets):
+            print_if_true(not quiet_option, f"Producing dependency file '{basename}.d'")
+            produceDepFile(basename + ".d", targets, source.source_files())
 
 
         print_if_true(not quiet_option, f"\nSize: {size} bytes\ncomplete.\n")
 
+        if (profile is not None):
+            produceProfile(profile, profiler, profile_option, profile_out)
+
         sys.exit(0)
     except (SyntaxError) as e:
         print(f"Syntax Error {e}")
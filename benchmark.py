@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+"""
+    Benchmarks for assembler.py
+
+    ./benchmark.py              throughput - the asm/ and demosrc/ sources (the corpus) plus generated
+                                stress programs of 10000, 100000 and 500000 lines - checked against benchmark.json
+    ./benchmark.py 20000 50000  ... stress programs of these sizes instead
+    ./benchmark.py -q           quick - the corpus and a 10000 line program
+    ./benchmark.py -s           save the results as the new baseline (benchmark.json)
+    ./benchmark.py -m           memory - assemble a generated 100000 line source
+    ./benchmark.py -m 250000    ... or as many lines as you like (up to about 130000 per 64K of output)
+    ./benchmark.py -x           hex writers - a full 32KB ROM program and the 32KB microcode ROM, written
+                                by logisim.MemoryFileWriter against the old write-per-byte/word code
+    ./benchmark.py -l           latency - assembling each corpus source over 'assembler.py --serve'
+    ./benchmark.py -l 200       ... 200 requests (cycling through the corpus) - against as many cold
+                                'python assembler.py file -n -q' runs of the same sources
+
+    Each program is assembled three ways - plain (best of a few runs) for lines/sec
+    and bytes/sec, with a Profile for the time in each phase, and with a memory
+    Profile (tracemalloc - slow) for the peak memory in each phase.
+
+    Against a baseline a program has regressed if it is more than SLOWER slower
+    (lines/sec), needs more than BIGGER more peak memory - or its output changed.
+    Timings only compare on the machine (and Python) the baseline was saved on.
+
+    The stress programs use every opcode the ISA tables define, with 8-bit operands
+    written every way the parser reads them - including '<' and '>' of labels - plus
+    .db, .dw (single values and lists), .fill, .ds and .dt directives, comments and labels referenced back and forward.
+    Each 64K only holds so much, so every block of the program has its own '.org'
+    and they wrap around the address space.
+
+    The hex writer benchmark keeps copies of the writers logisim.py replaced, which
+    wrote each byte or word with its own file.write(), and checks that both write
+    the same file.
+
+    The latency benchmark times each request from connecting to the server's
+    socket to reading its JSON answer - as an editor would see it - and each
+    cold run from starting the process to its exit.
+
+    The memory benchmark's source looks machine written - labels, comments and short
+    runs of code and table bytes - about half a byte of output per line.
+"""
+
+import sys
+import os.path
+import glob
+import json
+import hashlib
+import platform
+import time
+import tracemalloc
+import tempfile
+import socket
+import statistics
+import subprocess
+
+from assembler import assemble, Profile, produceV2HexFile, produceV3HexFile, ROM_ADDRESS
+from sap2dis import Decoder
+import logisim
+import buildcontrolrom
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark.json')
+CORPUS = ('asm/*.asm', 'demosrc/*.asm')
+STRESS_LINES = (10000, 100000, 500000)
+
+SLOWER = 0.15       # allowed fall in lines/sec
+BIGGER = 0.10       # allowed growth in peak memory
+
+BLOCK_STRIDE = 0x0400   # each stress block is assembled at the next 1K - wrapping at 64K
+ROM_SIZE = 0x8000
+
+ASSEMBLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assembler.py')
+
+
+def generate_source(lines: int) -> str:
+    """'lines' lines of generated source - 12 line blocks, 6 bytes of code and data in each"""
+    block = []
+    for index in range((lines + 11) // 12):
+        value = index & 0xff
+        block += [
+            f"; block {index} - generated",
+            f":blk{index}",
+            f"    movi r0,{value}",
+            f"    add r0,r1",
+            f"; step",
+            f"    .db {value}",
+            f"; table",
+            f"    movi r1,<blk{index}",
+            f"; done {index}",
+            f"",
+            f"; pad",
+            f"; pad",
+        ]
+    return ".org 0x0000\n" + '\n'.join(block[:lines]) + '\n'
+
+
+def stress_block(index: int, instructions: [(int, str)]) -> [str]:
+    """
+    One block of a stress program - every instruction, then data. 'instructions'
+    is the (size, text) of each opcode - the text ending where its operand goes.
+    """
+    previous = f'blk{index - 1}' if index else f'blk{index}'
+    bytes8 = lambda value: (f'0x{value:02x}', f'{value}', f'0b{value:08b}', f'0o{value:o}',
+                            f'<blk{index}', f'>end{index}', f'<{previous}', f'>l{index}_0')
+    words = lambda value: (f'blk{index}', f'end{index}', f'0x{value:04x}', previous, f'l{index}_0', f'{value}')
+
+    lines = [f"; block {index} - every opcode", f"    .org 0x{index * BLOCK_STRIDE % 0x10000:04x}", f":blk{index}"]
+    for count, (size, text) in enumerate(instructions):
+        value = (index * 7 + count * 13) & 0xffff
+        if (count % 16 == 0):
+            lines.append(f":l{index}_{count // 16}")
+        if (size == 1):
+            lines.append(f"    {text}")
+        elif (size == 2):
+            operands = bytes8(value & 0xff)
+            lines.append(f"    {text}{operands[count % len(operands)]}")
+        else:
+            operands = words(value)
+            lines.append(f"    {text}{operands[count % len(operands)]}    ; operand {count}")
+        if (count % 10 == 9):
+            lines += ["", f"; {count + 1} done"]
+
+    lines += [
+        f"; data",
+        f"    .dt 'BLOCK {index} - SAP2 STRESS TEST!'",
+        f"    .db 0x{index & 0xff:02x}",
+        f"    .db {index & 0x7f}",
+        f"    .dw 0x{index & 0xffff:04x}",
+        f"    .dw {index & 0xffff}",
+        f"    .db " + ','.join(f'0x{(index + count) & 0xff:02x}' for count in range(16)),
+        f"    .dw 0x{index & 0xffff:04x},{index & 0x7fff},0b{index & 0xff:b}",
+        f"    .fill 8,0x{index & 0xff:02x}",
+        f"    .ds 3",
+        f":end{index}",
+        f"",
+    ]
+    return lines
+
+
+def generate_stress(lines: int) -> str:
+    """
+    A stress program of 'lines' lines - whole blocks (so every label referenced is
+    defined), then comments to make up the count.
+    """
+    decoder = Decoder()
+    instructions = [(size, text) for size, text, flow in filter(None, decoder.table)]
+    source = []
+    index = 0
+    while True:
+        block = stress_block(index, instructions)
+        if (len(source) + len(block) > lines):
+            break
+        source += block
+        index += 1
+    source += [f"; padding {count}" for count in range(lines - len(source))]
+    return '\n'.join(source) + '\n'
+
+
+def corpus_sources(root: str = None) -> [(str, str)]:
+    """(filename, text) of each source in the corpus"""
+    root = root or os.path.dirname(os.path.abspath(__file__))
+    sources = []
+    for pattern in CORPUS:
+        for path in sorted(glob.glob(os.path.join(root, pattern))):
+            with open(path) as f:
+                sources.append((path, f.read()))
+    return sources
+
+
+def assemble_all(sources: [(str, str)], profile: Profile = None) -> (int, int, str):
+    """Assemble each (filename, text) - returns the bytes assembled, errors and a digest of the output"""
+    size = errors = 0
+    digest = hashlib.sha256()
+    for filename, text in sources:
+        image = assemble(text, filename = filename, profile = profile)
+        size += image.size()
+        errors += image.errors
+        digest.update(image.tobytes())
+    return size, errors, digest.hexdigest()
+
+
+def throughput_benchmark(name: str, sources: [(str, str)], repeats: int = 1) -> dict:
+    """lines/sec and bytes/sec of assembling 'sources' - and the time and peak memory of each phase"""
+    lines = sum(text.count('\n') for filename, text in sources)
+    elapsed = None
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        size, errors, digest = assemble_all(sources)
+        elapsed = min(elapsed or float('inf'), time.perf_counter() - start)
+
+    profile = Profile()
+    assemble_all(sources, profile)
+    timed = profile.results()
+
+    tracemalloc.start()
+    profile = Profile(memory = True)
+    assemble_all(sources, profile)
+    traced = profile.results()
+    tracemalloc.stop()
+
+    phases = {}
+    for phase, result in timed['phases'].items():
+        seconds = max(result['seconds'], 1e-9)
+        phases[phase] = {'calls': result['calls'], 'seconds': result['seconds'],
+                         'lines_per_sec': lines / seconds, 'bytes_per_sec': size / seconds,
+                         'peak': traced['phases'].get(phase, {}).get('peak')}
+    return {'name': name, 'lines': lines, 'bytes': size, 'errors': errors, 'digest': digest,
+            'seconds': elapsed, 'lines_per_sec': lines / elapsed, 'bytes_per_sec': size / elapsed,
+            'peak': traced['peak'], 'phases': phases}
+
+
+def run_suite(stress_lines: [int] = STRESS_LINES) -> dict:
+    programs = [('corpus', corpus_sources(), 5)]
+    programs += [(f'stress-{lines}', [(f'stress-{lines}.asm', generate_stress(lines))], max(1, min(5, 200000 // lines)))
+                    for lines in stress_lines]
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'node': platform.node(),
+            'programs': {name: throughput_benchmark(name, sources, repeats) for name, sources, repeats in programs}}
+
+
+def regressions(results: dict, baseline: dict) -> [str]:
+    """What got slower, bigger or different since the baseline"""
+    found = []
+    for name, result in results['programs'].items():
+        before = baseline['programs'].get(name)
+        if (before is None):
+            continue
+        if (result['digest'] != before['digest'] or result['errors'] != before['errors']):
+            found.append(f"{name}: output changed ({result['bytes']} bytes {result['errors']} errors, was {before['bytes']} bytes {before['errors']} errors)")
+        if (result['lines_per_sec'] < before['lines_per_sec'] * (1 - SLOWER)):
+            found.append(f"{name}: {result['lines_per_sec']:.0f} lines/sec, was {before['lines_per_sec']:.0f}")
+        if (result['peak'] > before['peak'] * (1 + BIGGER)):
+            found.append(f"{name}: peak memory {result['peak'] / (1<<20):.1f} MB, was {before['peak'] / (1<<20):.1f} MB")
+    return found
+
+
+def memory_benchmark(lines: int = 100000, listing: bool = False) -> dict:
+    """Peak memory while assembling - and what the finished image still holds"""
+    source = generate_source(lines)
+    tracemalloc.start()
+    start = time.perf_counter()
+    image = assemble(source, listing = listing)
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'lines': lines, 'listing': listing, 'bytes': image.size(), 'errors': image.errors,
+            'operations': len(image.ops), 'peak': peak, 'retained': retained, 'elapsed': elapsed}
+
+
+def rom_source(size: int = ROM_SIZE) -> str:
+    """A program filling a 'size' byte ROM at 0x0000 - every opcode in turn, padded out with .db"""
+    instructions = [(size, text) for size, text, flow in filter(None, Decoder().table)]
+    lines = ["    .org 0x0000", ":rom"]
+    used = 0
+    for count in range(size):
+        length, text = instructions[count % len(instructions)]
+        if (used + length > size):
+            break
+        operand = {1: '', 2: f'0x{count & 0xff:02x}', 3: 'rom'}[length]
+        lines.append(f"    {text}{operand}")
+        used += length
+    lines += ["    .db 0"] * (size - used)
+    return '\n'.join(lines) + '\n'
+
+
+# The writers logisim.MemoryFileWriter replaced - a file.write() for every byte or word
+
+def old_v2_hex_file(name: str, image) -> int:
+    file = open(name, "w+")
+    file.write("v2.0 raw\n")
+    totalsize = 0
+    bcnt = 0
+    for op,binarray in image.contents():
+        if op.size > 0:
+            totalsize += len(binarray)
+            for index, bytecode in enumerate(binarray):
+                file.write(f"{bytecode:02x} ")
+                if (bcnt % 8 == 7):
+                    file.write("\n")
+                bcnt += 1
+    file.write("\n")
+    file.close()
+    return totalsize
+
+
+def old_v3_hex_file(name: str, image, addrOffset: int) -> int:
+    file = open(name, "w+")
+    file.write("v3.0 hex words addressed\n")
+    totalsize = 0
+    lastaddrfromORG = -1
+    bytecountfromORG = 0
+    for op,binarray in image.contents():
+        sz = len(binarray)
+        totalsize += sz
+        address = op.pc
+        if (address != lastaddrfromORG) and \
+            (op.operation == 'org' or (lastaddrfromORG == -1 and sz > 0)):
+            bytecountfromORG = 0
+            lastaddrfromORG = address
+            file.write(f"\n{ address - (addrOffset if addrOffset <= address else 0):04x}: ")
+        if (sz > 0):
+            for index,byteopcode in enumerate(binarray):
+                if (bytecountfromORG % 32 == 31):
+                    file.write(f"\n{(address  + index - addrOffset if addrOffset <= address else 0):04x}: ")
+                file.write(f"{byteopcode:02x} ")
+                bytecountfromORG += 1
+    file.write("\n")
+    file.close()
+    return totalsize
+
+
+def old_rom_file(name: str, rows: [[int]]) -> None:
+    file = open(name, "w+")
+    file.write("v2.0 raw\n")
+    for words in rows:
+        for word in words:
+            file.write(f"{word:08x} ")
+        file.write("\n")
+    file.close()
+
+
+def rom_file(name: str, rows: [[int]]) -> None:
+    with logisim.open_memory_file(name) as rom:
+        for words in rows:
+            rom.word_row(words)
+
+
+def microcode_rows() -> [[int]]:
+    """The 256 rows of 32 words in microcode32bit.rom - as buildcontrolrom.produce32BitROMNEW writes them"""
+    if (not buildcontrolrom.opcodeTable):
+        buildcontrolrom.buildMicrocode()
+    nop = buildcontrolrom.buildNOPControlWord()
+    fetch = [buildcontrolrom.buildControlWord(words, nop) for words in buildcontrolrom.fetchControlWords]
+    rows = []
+    for bcode in range(256):
+        op = buildcontrolrom.opcodeTable.get(bcode)
+        words = fetch + (op['controlwords'] if op else [])
+        rows.append(words + [nop] * (32 - len(words)))
+    return rows
+
+
+def hex_writer_benchmark(repeats: int = 15) -> [dict]:
+    """Best of 'repeats' for each writer, old and new - and whether they wrote the same file"""
+    image = assemble(rom_source(), origin = ROM_ADDRESS, rom = True)
+    rows = microcode_rows()
+    writers = [
+        ('v2 hex (32KB ROM program)', lambda name: old_v2_hex_file(name, image), lambda name: produceV2HexFile(name, image)),
+        ('v3 hex (32KB ROM program)', lambda name: old_v3_hex_file(name, image, ROM_ADDRESS),
+                                      lambda name: produceV3HexFile(name, image, ROM_ADDRESS)),
+        ('microcode ROM (256 x 32 words)', lambda name: old_rom_file(name, rows), lambda name: rom_file(name, rows)),
+    ]
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, old, new in writers:
+            result = {'name': name, 'bytes': image.size()}
+            for which, writer in (('old', old), ('new', new)):
+                path = os.path.join(directory, f'{which}.hex')
+                elapsed = None
+                for repeat in range(repeats):
+                    start = time.perf_counter()
+                    writer(path)
+                    elapsed = min(elapsed or float('inf'), time.perf_counter() - start)
+                with open(path) as f:
+                    result[which] = {'seconds': elapsed, 'text': f.read()}
+            result['same'] = result['old'].pop('text') == result['new'].pop('text')
+            results.append(result)
+    return results
+
+
+def serve_request(path: str, request: dict) -> dict:
+    """One request on a fresh connection to the server at 'path'"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(json.dumps(request).encode() + b'\n')
+        with client.makefile('rb') as answer:
+            return json.loads(answer.readline())
+
+
+def start_server(path: str, timeout: float = 10.0) -> subprocess.Popen:
+    """'assembler.py --serve path' - once it answers"""
+    server = subprocess.Popen([sys.executable, ASSEMBLER, '--serve', path, '-q'],
+                              stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            serve_request(path, {'source': ''})
+            return server
+        except OSError:
+            if (server.poll() is not None or time.perf_counter() > deadline):
+                server.kill()
+                raise RuntimeError(f"assembler.py --serve {path} did not start")
+            time.sleep(0.05)
+
+
+def latency_summary(times: [float]) -> dict:
+    times = sorted(times)
+    return {'requests': len(times), 'mean': statistics.mean(times), 'median': statistics.median(times),
+            'p95': times[min(len(times) - 1, int(len(times) * 0.95))]}
+
+
+def latency_benchmark(requests: int = None) -> dict:
+    """Per request latency of a warm 'assembler.py --serve' against cold 'python assembler.py' runs"""
+    paths = [path for path, text in corpus_sources()]
+    paths = [paths[index % len(paths)] for index in range(requests or len(paths))]
+
+    served = []
+    errors = 0
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sap2.sock')
+        server = start_server(path)
+        try:
+            for source in paths:
+                start = time.perf_counter()
+                response = serve_request(path, {'path': source})
+                served.append(time.perf_counter() - start)
+                errors += 'error' in response
+        finally:
+            server.terminate()
+            server.wait()
+
+        cold = []
+        for source in paths:
+            start = time.perf_counter()
+            subprocess.run([sys.executable, ASSEMBLER, source, '-n', '-q'], cwd = directory,
+                           stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            cold.append(time.perf_counter() - start)
+
+    return {'served': latency_summary(served), 'cold': latency_summary(cold), 'failed': errors}
+
+
+
+if __name__ == '__main__':
+
+    options = {arg[1:] for arg in sys.argv[1:] if arg.startswith('-')}
+    numbers = [int(arg) for arg in sys.argv[1:] if not arg.startswith('-')]
+
+    if ('h' in options):
+        print(__doc__)
+        sys.exit(0)
+
+    if ('m' in options):
+        lines = numbers[0] if numbers else 100000
+        for listing in (False, True):
+            result = memory_benchmark(lines, listing)
+            print(f"{result['lines']} lines{' (listing)' if listing else '':10} {result['bytes']:6} bytes {result['errors']} errors"
+                  f" {result['operations']:7} operations kept"
+                  f"  peak {result['peak'] / (1<<20):6.1f} MB  retained {result['retained'] / (1<<20):6.1f} MB"
+                  f"  {result['elapsed']:.2f}s (traced)")
+        sys.exit(0)
+
+    if ('l' in options):
+        result = latency_benchmark(numbers[0] if numbers else None)
+        for name, times in (('--serve', result['served']), ('cold CLI', result['cold'])):
+            print(f"{name:10} {times['requests']:5} requests  mean {times['mean'] * 1000:7.2f} ms"
+                  f"  median {times['median'] * 1000:7.2f} ms  p95 {times['p95'] * 1000:7.2f} ms")
+        print(f"--serve is {result['cold']['mean'] / result['served']['mean']:.1f}x faster per request"
+              + (f" - {result['failed']} requests failed" if result['failed'] else ''))
+        sys.exit(-1 if result['failed'] else 0)
+
+    if ('x' in options):
+        results = hex_writer_benchmark()
+        for result in results:
+            print(f"{result['name']:32} old {result['old']['seconds'] * 1000:7.2f} ms  new {result['new']['seconds'] * 1000:7.2f} ms"
+                  f"  {result['old']['seconds'] / result['new']['seconds']:5.1f}x  {'same output' if result['same'] else '***OUTPUT DIFFERS***'}")
+        sys.exit(0 if all(result['same'] for result in results) else -1)
+
+    results = run_suite(numbers or ((10000,) if 'q' in options else STRESS_LINES))
+
+    for name, result in results['programs'].items():
+        print(f"{name:14} {result['lines']:7} lines {result['bytes']:8} bytes {result['errors']:3} errors"
+              f"  {result['seconds']:7.3f}s {result['lines_per_sec']:8.0f} lines/sec {result['bytes_per_sec']:8.0f} bytes/sec"
+              f"  peak {result['peak'] / (1<<20):6.1f} MB")
+        for phase, times in result['phases'].items():
+            peak = '' if times['peak'] is None else f"  peak {times['peak'] / (1<<20):6.1f} MB"
+            print(f"    {phase:16} {times['seconds']:7.3f}s {times['lines_per_sec']:10.0f} lines/sec {times['bytes_per_sec']:10.0f} bytes/sec{peak}")
+
+    if ('s' in options):
+        with open(BASELINE, 'w') as f:
+            json.dump(results, f, indent = 1)
+        print(f"Baseline saved to '{BASELINE}'")
+    elif (os.path.isfile(BASELINE)):
+        with open(BASELINE) as f:
+            found = regressions(results, json.load(f))
+        for regression in found:
+            print(f"***REGRESSION*** {regression}")
+        print("No regressions against the baseline" if not found else f"{len(found)} regressions against the baseline")
+        sys.exit(-1 if found else 0)
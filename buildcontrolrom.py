@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+from logisim import open_memory_file
+
 controlWordSize = 32
 ACTIVEHIGH = 1
 ACTIVELOW = 0
@@ -177,7 +179,7 @@ opcodes = [
    # Legacy instructions - which work on A/B regsiters
     # Legacy OPCODES TBDeprecated
 
-    {'name':'ADD','bytecode': 0x03,
+    {'name':'ADD','bytecode': 0x03, 'legacy':True,
     'control':
     [
         {'Ep','nLm'},
@@ -190,7 +192,7 @@ opcodes = [
         {'nLa','Eu','Lf'}
     ]},
 
-    {'name':'SUB','bytecode': 0x04,
+    {'name':'SUB','bytecode': 0x04, 'legacy':True,
         'control':
         [
             {'Ep','nLm'},
@@ -206,7 +208,7 @@ opcodes = [
 
 
 
-    {'name':'JMP','bytecode': 0x05,
+    {'name':'JMP','bytecode': 0x05, 'legacy':True,
     'control':
     [
         {'Ep','nLm'},
@@ -217,7 +219,7 @@ opcodes = [
     ]},
 
 
-    {'name':'JPNZ','bytecode': 0x06,
+    {'name':'JPNZ','bytecode': 0x06, 'legacy':True,
     'control':
     [
         {'Ep','nLm'},
@@ -227,7 +229,7 @@ opcodes = [
         {'E16','Lp','f0'},        # Enable both bytes of 2 address reg Write to PC if condition true
     ]},
 
-    {'name':'LDI','bytecode': 0x07,
+    {'name':'LDI','bytecode': 0x07, 'legacy':True,
     'control':
     [
         {'Ep','nLm'},
@@ -236,7 +238,7 @@ opcodes = [
     ]},
 
 
-    {'name':'SUBI','bytecode': 0x08,
+    {'name':'SUBI','bytecode': 0x08, 'legacy':True,
     'control':
     [
         {'Ep','nLm'},
@@ -244,14 +246,14 @@ opcodes = [
         {'nLa','Eu','Su','Lf'}
     ]},
 
-    {'name':'OUT','bytecode': 0x09,
+    {'name':'OUT','bytecode': 0x09, 'legacy':True,
     'control':
     [
         {'Ea','nLo'},
     ]},
 
 
-    {'name':'LDA','bytecode': 0x0a, 'control':
+    {'name':'LDA','bytecode': 0x0a, 'legacy':True, 'control':
     [
         {'Ep','nLm'},
         {'Cp','nCE','nLal'},  # inc pc to point to high byte of address
@@ -262,7 +264,7 @@ opcodes = [
     ]},
 
 
-    {'name':'STA','bytecode': 0x0b, 'control':
+    {'name':'STA','bytecode': 0x0b, 'legacy':True, 'control':
     [
         {'Ep','nLm'},
         {'Cp','nCE','nLal'},  # inc pc to point to high byte of address
@@ -1590,6 +1592,86 @@ opcodes = [
 ]
 
 
+# Assembler syntax for the opcodes above. isa.py compiles this table along with
+# 'opcodes' into the encode/decode tables used by assembler.py - so a new
+# instruction only needs adding here.
+#
+# 'form' says how the operands are folded into the opcode byte
+#   single   - no operands
+#   reg      - 'bytecode' | reg (r0-r3)
+#   regreg   - 'bytecode' | reg<<2 | regr
+#   word     - no register, 16-bit address follows
+#   operand  - 'bytecodes' looked up by the operand
+#   indirect - 'bytecodes' looked up by (reg, register pair)
+# 'size' is the number of bytes - any after the opcode are immediate data.
+# 'unimplemented' marks a mnemonic whose opcodes don't all have microcode yet -
+# isa.py refuses any other opcode without microcode, and any microcode (not
+# marked 'legacy') which no mnemonic produces.
+
+mnemonics = [
+    {'mnemonic':'nop', 'form':'single', 'size':1, 'bytecode':0x00},
+    {'mnemonic':'clc', 'form':'single', 'size':1, 'bytecode':0x01},
+    {'mnemonic':'setc', 'form':'single', 'size':1, 'bytecode':0x02},
+
+    {'mnemonic':'out', 'form':'reg', 'size':1, 'bytecode':0x10},
+    {'mnemonic':'ld', 'form':'reg', 'size':3, 'bytecode':0x14},
+    {'mnemonic':'st', 'form':'reg', 'size':3, 'bytecode':0x18},
+
+    {'mnemonic':'movwi', 'form':'operand', 'size':3, 'bytecodes':{'sp':0x1c, 'r0':0x28, 'r1':0x28, 'r2':0x2a, 'r3':0x2a}},
+    {'mnemonic':'incsp', 'form':'single', 'size':1, 'bytecode':0x1d},
+    {'mnemonic':'decsp', 'form':'single', 'size':1, 'bytecode':0x1e},
+
+    {'mnemonic':'pushr0', 'form':'single', 'size':1, 'bytecode':0x1f},
+    {'mnemonic':'pushr2', 'form':'single', 'size':1, 'bytecode':0x20},
+    {'mnemonic':'pushall', 'form':'single', 'size':1, 'bytecode':0x21},
+    {'mnemonic':'popr0', 'form':'single', 'size':1, 'bytecode':0x22},
+    {'mnemonic':'popr2', 'form':'single', 'size':1, 'bytecode':0x23},
+    {'mnemonic':'popall', 'form':'single', 'size':1, 'bytecode':0x24},
+    {'mnemonic':'exx', 'form':'single', 'size':1, 'bytecode':0x25},
+
+    {'mnemonic':'swp', 'form':'regreg', 'size':1, 'bytecode':0x30, 'unimplemented':True},
+
+    {'mnemonic':'movi', 'form':'reg', 'size':2, 'bytecode':0x40},
+    {'mnemonic':'xori', 'form':'reg', 'size':2, 'bytecode':0x44},
+
+    {'mnemonic':'csp', 'form':'operand', 'size':1, 'bytecodes':{0:0x48, 1:0x48, 2:0x49, 3:0x49}},
+    {'mnemonic':'ist', 'form':'indirect', 'size':1, 'bytecodes':{(2,'r0'):0x4a, (2,'r1'):0x4a, (3,'r0'):0x4b, (3,'r1'):0x4b}},
+    {'mnemonic':'ild', 'form':'indirect', 'size':1, 'bytecodes':{(2,'r0'):0x4e, (2,'r1'):0x4e, (3,'r0'):0x4f, (3,'r1'):0x4f}},
+
+    {'mnemonic':'addi', 'form':'reg', 'size':2, 'bytecode':0x50},
+    {'mnemonic':'subi', 'form':'reg', 'size':2, 'bytecode':0x54},
+    {'mnemonic':'andi', 'form':'reg', 'size':2, 'bytecode':0x58},
+    {'mnemonic':'ori', 'form':'reg', 'size':2, 'bytecode':0x5c},
+
+    {'mnemonic':'djnz', 'form':'reg', 'size':3, 'bytecode':0x60},
+    {'mnemonic':'jpz', 'form':'word', 'size':3, 'bytecode':0x64},
+    {'mnemonic':'jpnz', 'form':'word', 'size':3, 'bytecode':0x65},
+    {'mnemonic':'jpc', 'form':'word', 'size':3, 'bytecode':0x66},
+    {'mnemonic':'jpnc', 'form':'word', 'size':3, 'bytecode':0x67},
+    {'mnemonic':'jps', 'form':'word', 'size':3, 'bytecode':0x68, 'unimplemented':True},
+    {'mnemonic':'jpns', 'form':'word', 'size':3, 'bytecode':0x69, 'unimplemented':True},
+    {'mnemonic':'jpv', 'form':'word', 'size':3, 'bytecode':0x6a},
+    {'mnemonic':'jpnv', 'form':'word', 'size':3, 'bytecode':0x6b},
+    {'mnemonic':'jmp', 'form':'word', 'size':3, 'bytecode':0x6c},
+    {'mnemonic':'call', 'form':'word', 'size':3, 'bytecode':0x6e},
+    {'mnemonic':'ret', 'form':'single', 'size':1, 'bytecode':0x6f},
+
+    {'mnemonic':'shr', 'form':'reg', 'size':1, 'bytecode':0x80},
+    {'mnemonic':'shl', 'form':'reg', 'size':1, 'bytecode':0x84},
+    {'mnemonic':'inc', 'form':'reg', 'size':1, 'bytecode':0x88},
+    {'mnemonic':'dec', 'form':'reg', 'size':1, 'bytecode':0x8c},
+
+    {'mnemonic':'mov', 'form':'regreg', 'size':1, 'bytecode':0x90},
+    {'mnemonic':'add', 'form':'regreg', 'size':1, 'bytecode':0xa0},
+    {'mnemonic':'sub', 'form':'regreg', 'size':1, 'bytecode':0xb0},
+    {'mnemonic':'and', 'form':'regreg', 'size':1, 'bytecode':0xc0},
+    {'mnemonic':'or', 'form':'regreg', 'size':1, 'bytecode':0xd0},
+    {'mnemonic':'xor', 'form':'regreg', 'size':1, 'bytecode':0xe0},
+
+    {'mnemonic':'hlt', 'form':'single', 'size':1, 'bytecode':0xff},
+]
+
+
 # Calculate the NOP microcode control word
 
 def buildNOPControlWord():
@@ -1670,18 +1752,11 @@ def produce32BitNOPROM(romName, raw = True):
 
     print("Producing 32bit Rom")
 
-    file = open(romName, "w+")
-    file.write("v2.0 raw\n")
-
     # 256*32 ops
     nopCntWord = buildNOPControlWord()
 
-    for n in range(32*256):
-        file.write(f"{nopCntWord:08x} ")
-        if (n % 8 == 7):
-            file.write("\n")
-
-    file.close()
+    with open_memory_file(romName) as rom:
+        rom.word_rows([nopCntWord] * (32*256), 8)
 
 # Produce LogiSim memory file ROM/RAM  files
 # from opcodes control word arrays.
@@ -1700,30 +1775,12 @@ def produce32BitROMNEW(romName, raw = True):
 
     print(f"Producing 32bit Rom NOP {nopCntWord:08x}")
 
-    file = open(romName, "w+")
-    file.write("v2.0 raw\n")
+    with open_memory_file(romName) as rom:
+        for bcode in range(256):
+            words = fetchWords + (opcodeTable[bcode]['controlwords'] if bcode in opcodeTable else [])
 
-    for bcode in range(256):
-        bcodeExists = bcode in opcodeTable
-
-        for word in fetchWords:
-            file.write(f"{word:08x} ")
-
-        remaining =  32 - len(fetchWords) -   (0 if not bcodeExists else len(opcodeTable[bcode]['controlwords']))
-
-        if (bcode in opcodeTable):
-            op = opcodeTable[bcode]
-
-            for word in op['controlwords']:
-                file.write(f"{word:08x} ")
-
-        # Finish off trailing opcodes with NOPs
-        for i in range(remaining):
-            file.write(f"{nopCntWord:08x} ")
-
-        file.write("\n")
-
-    file.close()
+            # Finish off trailing opcodes with NOPs
+            rom.word_row(words + [nopCntWord] * (32 - len(words)))
 
 
 # Produce LogiSim memory file ROM/RAM  files
@@ -1864,21 +1921,23 @@ def listMicrocode():
 
 
 
-# Main Code
+# Main Code - isa.py imports this file for the 'opcodes' and 'mnemonics' tables
+
+if __name__ == '__main__':
 
-try:
+    try:
 
-    # DEBUG calculate Control Words for T1,T2,T3
+        # DEBUG calculate Control Words for T1,T2,T3
 
-    #NOPWord = buildNOPControlWord()
+        #NOPWord = buildNOPControlWord()
 
-    #for tstateInd, dfn in enumerate(fetchControlWords):
-    #    cw = buildControlWord(dfn,NOPWord)
-        #print(f"T{tstateInd + 1:01d} controlword {cw:06x}")
+        #for tstateInd, dfn in enumerate(fetchControlWords):
+        #    cw = buildControlWord(dfn,NOPWord)
+            #print(f"T{tstateInd + 1:01d} controlword {cw:06x}")
 
-    buildMicrocode()
-    listMicrocode()
-    produceROMs(romType = 0, raw = True)
+        buildMicrocode()
+        listMicrocode()
+        produceROMs(romType = 0, raw = True)
 
-except Exception as e:
-    print(f"**ERROR** {e}")
+    except Exception as e:
+        print(f"**ERROR** {e}")
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+    SAP2 instruction set tables - compiled from buildcontrolrom.py
+
+    buildcontrolrom.py defines the microcode for each opcode ('opcodes') and the
+    assembler syntax which produces it ('mnemonics'). Both are joined here into
+
+        decode   - 256 entries, opcode -> Instruction (None if no mnemonic produces it)
+        encoding - mnemonic -> Encoding
+
+    so the assembler and disassemblers can never disagree with the microcode ROM.
+    The compiled tables are pickled to .sap2cache (next to this file) and only
+    compiled again when buildcontrolrom.py or isa.py change.
+
+    ./isa.py     lists the instruction set - flagging opcodes with no microcode
+"""
+
+import os.path
+import hashlib
+import pickle
+import functools
+from typing import NamedTuple
+
+
+FORMS = ('single', 'reg', 'regreg', 'word', 'operand', 'indirect')
+
+# How control leaves an instruction
+NEXT = 0        # falls through to the next instruction
+BRANCH = 1      # to its 16-bit operand - or falls through
+JUMP = 2        # to its 16-bit operand only
+STOP = 3        # nowhere we can follow
+
+JUMPS = {'jmp'}
+STOPS = {'ret', 'hlt'}
+
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+CONTROLROM_SOURCE = os.path.join(SOURCE_DIRECTORY, 'buildcontrolrom.py')
+CACHE_FILE = os.path.join(SOURCE_DIRECTORY, '.sap2cache', 'isa.pickle')
+
+
+class ISAError(Exception):
+        def __init__(self,msg):
+            self.msg = msg
+        def __str__(self):
+            return f"**ISAError**: {self.msg}"
+
+
+class Encoding(NamedTuple):
+    mnemonic : str
+    form : str
+    size : int
+    bytecode : int = None       # base opcode - operand bits are or'ed in
+    bytecodes : dict = None     # operand -> opcode for 'operand' and 'indirect' forms
+    unimplemented : bool = False    # some of its opcodes have no microcode yet
+
+    def opcodes(self) -> [(int, object, object)]:
+        """Every (opcode, reg, regr) the mnemonic can produce"""
+        if (self.form in ('single', 'word')):
+            return [(self.bytecode, None, None)]
+        if (self.form == 'reg'):
+            return [(self.bytecode | reg, reg, None) for reg in range(4)]
+        if (self.form == 'regreg'):
+            return [(self.bytecode | reg<<2 | regr, reg, regr) for reg in range(4) for regr in range(4)]
+        if (self.form == 'operand'):
+            return [(opcode, operand, None) for operand, opcode in self.bytecodes.items()]
+        return [(opcode, reg, regr) for (reg, regr), opcode in self.bytecodes.items()]
+
+
+class Instruction(NamedTuple):
+    opcode : int
+    mnemonic : str
+    form : str
+    size : int
+    reg : object = None         # operands which the opcode itself encodes
+    regr : object = None
+    tstates : int = None        # fetch + execute T states - None if the opcode has no microcode
+    name : str = None           # the microcode's name for the opcode
+
+    def flow(self) -> int:
+        """NEXT, BRANCH, JUMP or STOP - calls count as branches"""
+        if (self.mnemonic in STOPS):
+            return STOP
+        if (self.mnemonic in JUMPS):
+            return JUMP
+        if (self.form == 'word' or self.mnemonic == 'djnz'):
+            return BRANCH
+        return NEXT
+
+
+class InstructionSet:
+
+    def __init__(self, version: str):
+        self.version = version
+        self.decode = [None] * 256
+        self.encoding = {}
+        self.microcode = {}     # opcode -> (name, T states) of every opcode with microcode
+
+    def add(self, encoding: Encoding) -> None:
+        if (encoding.form not in FORMS):
+            raise ISAError(f"'{encoding.mnemonic}' has an unknown form '{encoding.form}'")
+        if (encoding.mnemonic in self.encoding):
+            raise ISAError(f"'{encoding.mnemonic}' is defined more than once")
+        self.encoding[encoding.mnemonic] = encoding
+
+        for opcode, reg, regr in encoding.opcodes():
+            current = self.decode[opcode]
+            if (current is not None and current.mnemonic != encoding.mnemonic):
+                raise ISAError(f"opcode 0x{opcode:02x} is produced by both '{current.mnemonic}' and '{encoding.mnemonic}'")
+            # Several operands may share an opcode ('movwi r0' and 'movwi r1') - the first decodes
+            if (current is None):
+                name, tstates = self.microcode.get(opcode, (None, None))
+                self.decode[opcode] = Instruction(opcode, encoding.mnemonic, encoding.form, encoding.size,
+                                                  reg, regr, tstates, name)
+
+    def unimplemented(self) -> [Instruction]:
+        """Opcodes the assembler can produce which have no microcode"""
+        return [instruction for instruction in self.decode if instruction is not None and instruction.tstates is None]
+
+    def unused(self) -> [int]:
+        """Opcodes with microcode which no mnemonic produces"""
+        return [opcode for opcode in sorted(self.microcode) if self.decode[opcode] is None]
+
+
+def source_version() -> str:
+    version = hashlib.sha256()
+    for path in (__file__, CONTROLROM_SOURCE):
+        with open(path, 'rb') as f:
+            version.update(f.read())
+    return version.hexdigest()
+
+
+def compile_isa(controlrom, version: str = None) -> InstructionSet:
+    """Join the 'opcodes' and 'mnemonics' tables of the buildcontrolrom module"""
+    isa = InstructionSet(version)
+    fetch = len(controlrom.fetchControlWords)
+    for op in controlrom.opcodes:
+        if (op['bytecode'] in isa.microcode):
+            raise ISAError(f"microcode for opcode 0x{op['bytecode']:02x} is defined more than once")
+        isa.microcode[op['bytecode']] = (op['name'].strip(), fetch + len(op['control']))
+
+    for mnemonic in controlrom.mnemonics:
+        isa.add(Encoding(mnemonic['mnemonic'], mnemonic['form'], mnemonic['size'],
+                         mnemonic.get('bytecode'), mnemonic.get('bytecodes'), mnemonic.get('unimplemented', False)))
+
+    # The bytecodes in 'mnemonics' are typed in by hand - so the two tables must cover each other exactly.
+    # Gaps are only allowed where they are declared ('unimplemented' mnemonics, 'legacy' microcode)
+    for instruction in isa.unimplemented():
+        if (not isa.encoding[instruction.mnemonic].unimplemented):
+            raise ISAError(f"'{instruction.mnemonic}' produces opcode 0x{instruction.opcode:02x} which has no microcode")
+    for encoding in isa.encoding.values():
+        if (encoding.unimplemented and all(opcode in isa.microcode for opcode, reg, regr in encoding.opcodes())):
+            raise ISAError(f"'{encoding.mnemonic}' is marked unimplemented but all its opcodes have microcode")
+    legacy = {op['bytecode'] for op in controlrom.opcodes if op.get('legacy')}
+    for opcode in isa.unused():
+        if (opcode not in legacy):
+            raise ISAError(f"microcode for opcode 0x{opcode:02x} ({isa.microcode[opcode][0]}) is not produced by any mnemonic")
+    return isa
+
+
+def store(isa: InstructionSet, path: str = CACHE_FILE) -> None:
+    """Best effort - the tables are simply compiled again next time if this fails"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp = path + f'.{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            pickle.dump(isa, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize = None)
+def instruction_set() -> InstructionSet:
+    """The compiled tables - from the cache if it is current, otherwise compiled (and cached)"""
+    version = source_version()
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            isa = pickle.load(f)
+        if (isa.version == version):
+            return isa
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError, AttributeError):
+        pass
+
+    import buildcontrolrom
+    isa = compile_isa(buildcontrolrom, version)
+    store(isa)
+    return isa
+
+
+
+if __name__ == '__main__':
+
+    # Always compiled afresh - a cache pickled from __main__ would not load in the assembler
+    import buildcontrolrom
+    isa = compile_isa(buildcontrolrom)
+    for instruction in isa.decode:
+        if (instruction is not None):
+            operands = ','.join(str(operand) for operand in (instruction.reg, instruction.regr) if operand is not None)
+            tstates = '**NO MICROCODE**' if instruction.tstates is None else f"T{instruction.tstates:<3} {instruction.name}"
+            print(f"0x{instruction.opcode:02x} {instruction.mnemonic:8}{operands:8}{instruction.size} {tstates}")
+
+    unused = isa.unused()
+    if (unused):
+        print("\nMicrocode with no mnemonic: " + ' '.join(f"0x{opcode:02x} ({isa.microcode[opcode][0]})" for opcode in unused))
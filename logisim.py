@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Writers for LogiSim memory image files - shared by assembler.py (program RAM/ROM)
+# and buildcontrolrom.py (microcode ROM).
+#
+# Rows are formatted whole - a table lookup per byte and one '%' format per row of
+# words - and the text is handed to the file in large chunks rather than one small
+# write per byte/word. (bytes.hex() only takes a separator from Python 3.8.)
+
+V2_HEADER = "v2.0 raw\n"
+V3_HEADER = "v3.0 hex words addressed\n"
+
+BYTE_TEXT = [f'{value:02x} ' for value in range(256)]
+
+
+class MemoryFileWriter:
+    """
+    Buffers the text of a LogiSim memory file and writes it out in chunks
+    of about 'chunk_size' characters. Use as a context manager - or call close().
+    """
+
+    def __init__(self, file, header: str = V2_HEADER, chunk_size: int = 1<<16):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.pending = 0
+        self.write(header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, text: str) -> None:
+        self.parts.append(text)
+        self.pending += len(text)
+        if (self.pending >= self.chunk_size):
+            self.flush()
+
+    def flush(self) -> None:
+        self.file.write(''.join(self.parts))
+        self.parts = []
+        self.pending = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+    def bytes(self, data) -> None:
+        """Bytes as 'xx ' - no line breaks"""
+        if (len(data) > 0):
+            self.write(''.join(map(BYTE_TEXT.__getitem__, data)))
+
+    def byte_rows(self, data, per_row: int = 8) -> None:
+        """Bytes as 'xx ', with a line break after each full row"""
+        rows = [''.join(map(BYTE_TEXT.__getitem__, data[index:index + per_row])) + '\n'
+                    for index in range(0, len(data) - per_row + 1, per_row)]
+        self.write(''.join(rows))
+        self.bytes(data[len(rows) * per_row:])
+
+    def word_row(self, words: [int]) -> None:
+        """A row of 32-bit words as 'xxxxxxxx ' followed by a line break"""
+        self.write('%08x ' * len(words) % tuple(words) + '\n')
+
+    def word_rows(self, words: [int], per_row: int) -> None:
+        for index in range(0, len(words), per_row):
+            self.word_row(words[index:index + per_row])
+
+
+def open_memory_file(name: str, header: str = V2_HEADER) -> MemoryFileWriter:
+    return MemoryFileWriter(open(name, "w+"), header)
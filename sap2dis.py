@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+    Dissassembler for SAP2 memory images
+
+    ./sap2dis.py program.bin        raw binary - loaded at 0x8000 (0x0000 with -r)
+    ./sap2dis.py program.hex        LogiSim 'v2.0 raw' or 'v3.0 hex words addressed' file
+    ./sap2dis.py dump.txt           output captured from the monitor's 'D' command ('8000: 28 FF FF ...')
+
+    Code is found by following control flow from the entry points - the start of
+    the image, plus any given with -eADDR. Jumps, calls and djnz are followed;
+    jmp, ret and hlt end a path. Anything never reached is listed as '.db' data.
+    The output is assembler source - it can be fed straight back into assembler.py.
+"""
+
+import sys
+import re
+import bisect
+
+import isa
+from isa import NEXT, BRANCH, STOP
+from assembler import ImageError, RAM_ADDRESS, ROM_ADDRESS
+
+
+# Mnemonics the assembler spells differently from the ISA tables
+SYNTAX = {
+    'incsp' : 'inc\tsp', 'decsp' : 'dec\tsp',
+    'pushr0' : 'push\tr0', 'pushr2' : 'push\tr2',
+    'popr0' : 'pop\tr0', 'popr2' : 'pop\tr2',
+}
+
+# '8000: 28 FF FF 48 ...' - a row of the monitor's 'D' command
+DUMP_LINE_RE = re.compile(r'^\s*([0-9A-Fa-f]{4}):((?:[ \t]+[0-9A-Fa-f]{2})+)[ \t]*\r?$', re.MULTILINE)
+
+# LogiSim memory file values - optionally run length encoded as 'count*value'
+HEX_VALUE_RE = re.compile(r'(?:([0-9]+)\*)?([0-9A-Fa-f]+)')
+
+
+class Image:
+
+    SIZE = 0x10000
+
+    def __init__(self):
+        self.memory = bytearray(self.SIZE)
+        self.loaded = bytearray(self.SIZE)      # 1 for each address the image gave a value for
+
+    def load(self, address: int, data: bytes) -> None:
+        if (address < 0 or address + len(data) > self.SIZE):
+            raise ImageError(f"{len(data)} bytes at 0x{address:04x} run outside the 64K address space")
+        self.memory[address:address + len(data)] = data
+        self.loaded[address:address + len(data)] = b'\x01' * len(data)
+
+    def segments(self) -> [(int, int)]:
+        """(start, end) of each run of loaded addresses"""
+        return [m.span() for m in re.finditer(rb'\x01+', self.loaded)]
+
+
+def hex_values(text: str) -> bytes:
+    values = bytearray()
+    for count, value in HEX_VALUE_RE.findall(text):
+        values += bytes([int(value, 16) & 0xff]) * (int(count) if count else 1)
+    return bytes(values)
+
+
+def read_image(path: str, base: int = RAM_ADDRESS) -> Image:
+    """Load a .bin, LogiSim v2/v3 .hex or monitor dump - .bin and v2 files have no addresses and load at 'base'"""
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    image = Image()
+    if (content.startswith(b'v2.0 raw')):
+        image.load(base, hex_values(content.decode('ascii').split('\n', 1)[1]))
+    elif (content.startswith(b'v3.0 hex')):
+        for line in content.decode('ascii').splitlines()[1:]:
+            address, sep, values = line.partition(':')
+            if (sep):
+                image.load(int(address, 16) + base, hex_values(values))
+    else:
+        text = content.decode('latin-1')
+        rows = DUMP_LINE_RE.findall(text)
+        if (rows):
+            for address, values in rows:
+                image.load(int(address, 16), bytes.fromhex(values))
+        else:
+            image.load(base, content)
+    return image
+
+
+class Decoder:
+    """
+    A 256 entry table, opcode -> (size, text, flow), built once from the ISA
+    tables. 'text' is the whole instruction for single byte opcodes - otherwise
+    the text in front of its immediate operand. None for opcodes no mnemonic produces.
+    The sizes and flows are also packed into bytes (size 0 for no mnemonic) - so a
+    whole image translates to the size and flow at every address in one go - and each
+    opcode's line is a '%' template, so the per instruction work is an index and a format.
+    """
+
+    COLUMN = 24     # comment column - after the tab
+
+    def __init__(self, instruction_set: isa.InstructionSet = None):
+        instruction_set = instruction_set or isa.instruction_set()
+        self.table = [None if instruction is None else self.entry(instruction) for instruction in instruction_set.decode]
+        self.sizes = bytes(0 if entry is None else entry[0] for entry in self.table)
+        self.flows = bytes(NEXT if entry is None else entry[2] for entry in self.table)
+        # Text in front of the operand and the padding after it - an operand is 4 (byte) or 6 (word) characters
+        self.heads = ['' if entry is None else '\t' + entry[1] for entry in self.table]
+        self.tails = ['' if entry is None else ' ' * max(0, self.COLUMN - len(entry[1]) - {1: 0, 2: 4, 3: 6}[entry[0]]) + '; '
+                            for entry in self.table]
+        # The whole line of each opcode - the operand (0x%02x or %s), its address and operand bytes to come
+        operands = {1: ('', ''), 2: ('0x%02x', ' %02x'), 3: ('%s', ' %02x %02x')}
+        self.templates = [None if entry is None else
+                            head.replace('%', '%%') + operands[entry[0]][0] + tail + f'%04x  {opcode:02x}' + operands[entry[0]][1]
+                            for opcode, (entry, head, tail) in enumerate(zip(self.table, self.heads, self.tails))]
+
+    @staticmethod
+    def entry(instruction: isa.Instruction) -> (int, str, int):
+        mnemonic, form, reg, regr = instruction.mnemonic, instruction.form, instruction.reg, instruction.regr
+        if (form == 'indirect'):
+            text = f'{mnemonic[1:]}\tr{reg},({regr})'
+        elif (form == 'regreg'):
+            text = f'{mnemonic}\tr{reg},r{regr}'
+        elif (form == 'operand' and isinstance(reg, str)):
+            text = f'{mnemonic}\t{reg},'
+        elif (form in ('reg', 'operand')):
+            text = f'{mnemonic}\tr{reg}' + (',' if instruction.size > 1 else '')
+        else:
+            text = SYNTAX.get(mnemonic, mnemonic) + ('\t' if instruction.size > 1 else '')
+        return instruction.size, text.expandtabs(8), instruction.flow()
+
+    def trace(self, image: Image, entries: [int]) -> (bytearray, set):
+        """
+        Follow control flow from the entry points. Returns a map with 1 at the
+        start of each instruction reached (2 on its operand bytes) - and the set of
+        addresses branched to.
+        """
+        memory = image.memory
+        # The size and flow of the instruction at every address - padded, so an instruction
+        # running off the top of memory just finds its operands not loaded
+        sizes = memory.translate(self.sizes) + bytes(3)
+        flows = memory.translate(self.flows)
+        loaded = image.loaded + bytes(3)
+        code = bytearray(len(loaded))
+        targets = set()
+        work = list(entries)
+        while work:
+            pc = work.pop()
+            while (loaded[pc] and not code[pc]):
+                size = sizes[pc]
+                if (size == 1):
+                    code[pc] = 1
+                elif (size == 0):
+                    break
+                else:
+                    end = pc + size
+                    # Stop rather than decode past the image or across an instruction already found
+                    if (not loaded[end - 1] or code[end - 1] or (size == 3 and (not loaded[pc + 1] or code[pc + 1]))):
+                        break
+                    code[pc] = 1
+                    code[pc + 1] = 2
+                    if (size == 3):
+                        code[pc + 2] = 2
+                flow = flows[pc]
+                if (flow != NEXT):
+                    end = pc + size
+                    if (flow != STOP):
+                        target = memory[end - 2] | memory[end - 1]<<8
+                        targets.add(target)
+                        work.append(target)
+                    if (flow != BRANCH):
+                        break
+                pc += size
+        return code[:Image.SIZE], targets
+
+    def dissassemble(self, image: Image, entries: [int] = None) -> [str]:
+        """Assembler source for the whole image"""
+        segments = image.segments()
+        if (not segments):
+            return []
+        entries = [segments[0][0]] if entries is None else entries
+        code, targets = self.trace(image, entries)
+
+        sizes, flows, templates, memory = self.sizes, self.flows, self.templates, image.memory
+        labels = sorted(target for target in targets if code[target] == 1)
+        names = {label: f'L{label:04x} ' for label in labels}       # padded to the width of '0x8000'
+        dbs = [f'\t.db 0x{value:02x}' for value in range(256)]
+
+        lines = []
+        append = lines.append
+        for start, end in segments:
+            append(f'\t.org 0x{start:04x}')
+            pc = start
+            while pc < end:
+                # A run of code or data - up to the next label or the other kind of byte
+                label = bisect.bisect_right(labels, pc)
+                stop = labels[label] if label < len(labels) and labels[label] < end else end
+                if (pc in names):
+                    append(f':{names[pc][:-1]}')
+                if (code[pc] == 1):
+                    data = code.find(0, pc, stop)
+                    stop = stop if data < 0 else data
+                    while pc < stop:
+                        opcode = memory[pc]
+                        size = sizes[opcode]
+                        if (size == 1):
+                            append(templates[opcode] % pc)
+                        elif (size == 2):
+                            value = memory[pc + 1]
+                            append(templates[opcode] % (value, pc, value))
+                        else:
+                            low, high = memory[pc + 1], memory[pc + 2]
+                            operand = low | high<<8
+                            text = names.get(operand) if flows[opcode] != NEXT else None
+                            append(templates[opcode] % (text or f"0x{operand:04x}", pc, low, high))
+                        pc += size
+                else:
+                    # Data - up to the next instruction or label
+                    instruction = code.find(1, pc, stop)
+                    stop = stop if instruction < 0 else instruction
+                    append(f'{dbs[memory[pc]]:{self.COLUMN + 1}}; {pc:04x}  data')
+                    lines.extend(dbs[value] for value in memory[pc + 1:stop])
+                    pc = stop
+        return lines
+
+
+
+if __name__ == '__main__':
+
+    def buildHelpText() -> str:
+        return "\n\nExample: ./sap2dis.py program.hex [options]\n\n -r ROM address offset - .bin and .hex files load at 0x0000 rather than 0x8000\n -eADDR also follow code from the hex address ADDR (repeat as needed)\n -h help\n\n Reads .bin, LogiSim v2/v3 .hex files and the monitor's 'D' dump output.\n"
+
+    def handleCommandArgs(argv: [str]) -> ([str],[str]):
+        """Command line options have NO parameters so just record them"""
+        options = set()
+        files = []
+        for arg in argv[1:]:
+            if (arg.startswith('-') and len(arg) > 1):
+                options.add(arg[1:])
+            else:
+                files.append(arg)
+        return options,files
+
+
+    options,imageFilenames = handleCommandArgs(sys.argv)
+
+    if ('h' in options or len(imageFilenames) != 1):
+        print(buildHelpText())
+        sys.exit(0 if 'h' in options else -1)
+
+    try:
+        entries = [int(opt[1:], 16) for opt in options if opt.startswith('e') and len(opt) > 1]
+        image = read_image(imageFilenames[0], ROM_ADDRESS if 'r' in options else RAM_ADDRESS)
+    except (IOError, ValueError, ImageError) as e:
+        print(e)
+        sys.exit(-1)
+
+    segments = image.segments()
+    decoder = Decoder()
+    lines = decoder.dissassemble(image, (segments[:1] and [segments[0][0]]) + entries)
+    sys.stdout.write('\n'.join(lines) + '\n')
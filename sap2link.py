@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+    Linker for SAP2 object files - as produced by 'assembler.py example.asm -o'
+
+    ./assembler.py main.asm -o
+    ./assembler.py maths.asm -o
+    ./sap2link.py main.o maths.o -3
+
+    A module with an '.org' stays at the addresses it was assembled for. Modules
+    without one are relocatable - they are laid out, in command line order, after
+    the highest absolute code in RAM (or from 0x8000 if there is none).
+
+    Each module's labels are exported. A reference resolves to the module's own
+    label first, then to an export of another module - a label defined by more
+    than one module can not be imported.
+"""
+
+import sys
+import os.path
+
+from assembler import AssemblerOperation, WordData, ProgramImage, ObjectModule, ImageError, \
+                      OutputType, RAM_ADDRESS, ROM_ADDRESS, outputFilenames, produceOutputFile
+
+
+class LinkError(Exception):
+        def __init__(self,msg):
+            self.msg = msg
+        def __str__(self):
+            return f"**LinkError**: {self.msg}"
+
+
+class Linker:
+
+    def __init__(self, modules: [ObjectModule], base: int = RAM_ADDRESS):
+        self.modules = modules
+        self.base = base
+        self.bases = []         # load address of each module
+        self.symbols = {}       # label -> address (None if defined by more than one module)
+
+    def layout(self) -> None:
+        top = max([address + len(data) for module in self.modules if not module.relocatable
+                        for address, data in module.segments if address + len(data) > self.base], default = self.base)
+
+        for module in self.modules:
+            self.bases.append(top if module.relocatable else 0)
+            if (module.relocatable):
+                top += module.size()
+
+        if (top > ProgramImage.SIZE):
+            raise LinkError(f"modules need {top - ProgramImage.SIZE} bytes more than the 64K address space")
+
+    def resolve(self) -> None:
+        for module, base in zip(self.modules, self.bases):
+            for labelnm, address in module.exports.items():
+                if (labelnm in self.symbols and self.symbols[labelnm] != address + base):
+                    self.symbols[labelnm] = None
+                else:
+                    self.symbols[labelnm] = address + base
+
+    def link(self) -> ProgramImage:
+        self.layout()
+        self.resolve()
+
+        # Check for overlaps first - so they are reported by module, not as an ImageError
+        placed = sorted((address + base, address + base + len(data), index)
+                        for index, (module, base) in enumerate(zip(self.modules, self.bases))
+                        for address, data in module.segments)
+        reach = (0, None)       # furthest end so far - and the module it belongs to
+        for start, end, index in placed:
+            if (start < reach[0] and index != reach[1]):
+                raise LinkError(f"'{self.modules[index].name}' overlaps '{self.modules[reach[1]].name}' at 0x{start:04x}")
+            reach = max(reach, (end, index), key = lambda r: r[0])
+
+        image = ProgramImage()
+        last = None             # end of the last segment placed
+        for module, base in zip(self.modules, self.bases):
+            for address, data in module.segments:
+                # Code following straight on from the last segment needs no new '.org'
+                if (last != address + base):
+                    org = AssemblerOperation(operation = 'org', pc = address + base, data = WordData(address + base))
+                    image.place(org, [])
+                image.place(AssemblerOperation(operation = 'db', pc = address + base, size = len(data)), data)
+                last = address + base + len(data)
+
+        for module, base in zip(self.modules, self.bases):
+            for relocation in module.relocations:
+                self.patch(image, module, base, relocation)
+
+        return image
+
+    def patch(self, image: ProgramImage, module: ObjectModule, base: int, relocation) -> None:
+        if (relocation.symbol in module.exports):
+            value = module.exports[relocation.symbol] + base
+        elif (relocation.symbol not in self.symbols):
+            raise LinkError(f"undefined symbol '{relocation.symbol}' imported by '{module.name}'")
+        elif (self.symbols[relocation.symbol] is None):
+            raise LinkError(f"symbol '{relocation.symbol}' imported by '{module.name}' is defined by more than one module")
+        else:
+            value = self.symbols[relocation.symbol]
+
+        address = relocation.address + base
+        if (relocation.kind == 'word'):
+            image.memory[address:address + 2] = bytes([value & 0xff, value>>8 & 0xff])
+        else:
+            image.memory[address] = value & 0xff if relocation.kind == 'low' else value>>8 & 0xff
+
+
+
+if __name__ == '__main__':
+
+    def print_if_true(check, str,*args,**kwargs):
+        if (check):
+            print(str,*args,**kwargs)
+
+    def buildHelpText() -> str:
+        return "\n\nExample: ./sap2link.py main.o maths.o [options]\n\n -q quiet\n -s symbol table\n -3 [default] V3 addressed hex output\n -2 raw hex output (to .v2.hex if given with -3)\n -b binary output\n -r ROM address offset on V3 Hex output\n\n Output is named after the first object file.\n"
+
+    def handleCommandArgs(argv: [str]) -> ([str],[str]):
+        """Command line options have NO parameters so just record them"""
+        options = set()
+        files = []
+        for arg in argv[1:]:
+            if (arg.startswith('-') and len(arg) > 1):
+                options.add(arg[1:])
+            else:
+                files.append(arg)
+        return options,files
+
+
+    options,objectFilenames = handleCommandArgs(sys.argv)
+
+    quiet_option = 'q' in options
+    symtable_option = 's' in options
+    rom_option = 'r' in options
+
+    if ('h' in options or not objectFilenames):
+        print(buildHelpText())
+        sys.exit(0 if objectFilenames else -1)
+
+    outTypes = [outType for outType,opt in ((OutputType.BINARY,'b'), (OutputType.RAWHEX,'2'), (OutputType.ADDRESSEDHEX,'3')) if opt in options]\
+                or [OutputType.ADDRESSEDHEX]
+
+    try:
+        modules = [ObjectModule.load(objName) for objName in objectFilenames]
+        linker = Linker(modules)
+        image = linker.link()
+    except (IOError, ImageError, LinkError) as e:
+        print(e)
+        print_if_true(not quiet_option, "Link Failed!")
+        sys.exit(-1)
+
+    for module, base in zip(modules, linker.bases):
+        print_if_true(not quiet_option, f"Module '{module.name}' at 0x{base + min([address for address, data in module.segments], default = 0):04x}{' (relocated)' if module.relocatable else ''}")
+
+    if (not quiet_option and symtable_option):
+        print("Symbol Table:")
+        for lbl, address in linker.symbols.items():
+            print(f"\t'{lbl}': " + ("<multiply defined>" if address is None else f"0x{address:04x}"))
+
+    basename = os.path.splitext(objectFilenames[0])[0]
+    binNames = outputFilenames(basename, outTypes)
+
+    for outType in outTypes:
+        binName = binNames[outType]
+        print_if_true(not quiet_option, f"Producing LogiSym output file '{binName}'")
+        size = produceOutputFile(outType, binName, image, ROM_ADDRESS if rom_option else RAM_ADDRESS)
+
+    print_if_true(not quiet_option, f"\nSize: {size} bytes\ncomplete.\n")
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+    Tests for the assembler's library API - python3 -m unittest (or pytest)
+"""
+
+import io
+import os
+import tempfile
+import contextlib
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from assembler import assemble, produceListing, produceDepFile, produceOutputFile, OutputType
+
+
+class ConcurrentAssembleTest(unittest.TestCase):
+
+    def source(self, undefined: int) -> str:
+        return ".org 0x8000\n:start\n movi r0,1\n" + ''.join(f" jmp missing{index}\n" for index in range(undefined)) + " hlt\n"
+
+    def test_each_call_keeps_its_own_diagnostics(self):
+        # A different number of undefined labels in each thread - so mixed up logs would show
+        counts = [500, 1000, 1500, 3000]
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), ThreadPoolExecutor(len(counts)) as pool:
+            images = list(pool.map(lambda count: assemble(self.source(count), filename = f'thread{count}.asm'), counts))
+
+        self.assertEqual(stdout.getvalue(), '')
+        for count, image in zip(counts, images):
+            self.assertEqual(image.errors, count)
+            self.assertEqual(len(image.log.splitlines()), count)
+            self.assertEqual(image.labels, {'start': 0x8000})
+
+    def test_concurrent_results_match_a_single_call(self):
+        with open('asm/mult16.asm') as f:
+            text = f.read()
+        expected = assemble(text, filename = 'asm/mult16.asm')
+        with ThreadPoolExecutor(4) as pool:
+            images = list(pool.map(lambda index: assemble(text, filename = 'asm/mult16.asm'), range(8)))
+        for image in images:
+            self.assertEqual(image.tobytes(), expected.tobytes())
+            self.assertEqual(image.labels, expected.labels)
+            self.assertEqual(image.errors, expected.errors)
+
+
+class OverlapTest(unittest.TestCase):
+
+    def test_org_over_placed_code_is_an_error(self):
+        image = assemble(".org 0x8000\n movi r0,1\n jmp there\n.org 0x8002\n:there\n hlt\n", filename = 'overlap.asm')
+        self.assertEqual(image.errors, 1)
+        self.assertIn("overwrites code already placed at 0x8002", image.log)
+
+    def test_fixups_do_not_count_as_overlaps(self):
+        image = assemble(".org 0x8000\n jmp there\n.org 0x8010\n:there\n hlt\n", filename = 'forward.asm')
+        self.assertEqual(image.errors, 0)
+        self.assertEqual(image.tobytes(), bytes([0x6c, 0x10, 0x80, 0xff]))
+
+
+class ListingTest(unittest.TestCase):
+
+    def test_op_at_and_branches_into_an_instruction(self):
+        image = assemble(".org 0x8000\n:start\n movi r0,1\n jmp 0x8001\n jmp start\n", filename = 'listing.asm', listing = True)
+        self.assertEqual(image.op_at(0x8002).operation, 'jmp')
+        self.assertIsNone(image.op_at(0x8001))
+        blocks = [line for line in produceListing(image, tstates = True) if '->' in line]
+        self.assertTrue(blocks[0].endswith('-> 8001 (mid-instruction)'))
+        self.assertTrue(blocks[1].endswith('-> 8000 start (back)'))
+
+
+class DepFileTest(unittest.TestCase):
+
+    def test_names_are_escaped_for_make(self):
+        with tempfile.TemporaryDirectory() as directory:
+            depName = os.path.join(directory, 'prog.d')
+            produceDepFile(depName, ['my prog.hex'], ['lib/$(X)#1 a.asm'])
+            with open(depName) as f:
+                self.assertEqual(f.read(), 'my\\ prog.hex: \\\n  lib/$$(X)\\#1\\ a.asm\n')
+
+
+class SectionTest(unittest.TestCase):
+
+    def test_unknown_section_and_device_are_named(self):
+        image = assemble(".section text\n.section code,flash\n", filename = 'section.asm')
+        self.assertEqual(image.errors, 2)
+        self.assertIn("Unknown section 'text' - expected code/rodata/bss", image.log)
+        self.assertIn("Unknown memory device 'flash' - expected rom/ram", image.log)
+
+
+class OutputFileTest(unittest.TestCase):
+
+    def test_a_failed_write_leaves_no_files(self):
+        image = assemble(".org 0x8000\n hlt\n", filename = 'out.asm')
+        def failed():
+            raise OSError('disk full')
+        image.segment_table = failed
+        with tempfile.TemporaryDirectory() as directory:
+            for outType in (OutputType.BINARY, OutputType.RAWHEX):
+                with self.assertRaises(OSError):
+                    produceOutputFile(outType, os.path.join(directory, 'out'), image)
+            self.assertEqual(os.listdir(directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()